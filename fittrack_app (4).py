@@ -1,10 +1,22 @@
 import streamlit as st
+import bisect
+import copy
+import csv
+import io
 import json
+import logging
 import os
+import re
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 # SST Color Palette
 SST_COLORS = {
     'red': '#d32f2f',
@@ -113,6 +125,7 @@ def update_user_data(data):
     save_users(st.session_state.users_data)
 
 # NAPFA grading standards
+# Built-in fallback, used when napfa_standards.json is missing or unreadable
 NAPFA_STANDARDS = {
     12: {
         'm': {
@@ -206,16 +219,706 @@ NAPFA_STANDARDS = {
     }
 }
 
-def calc_grade(score, cutoffs, reverse):
-    """Calculate grade from score and cutoffs"""
-    for i, cutoff in enumerate(cutoffs):
-        if reverse:
-            if score <= cutoff:
-                return 5 - i
-        else:
-            if score >= cutoff:
-                return 5 - i
-    return 0
+# Compiled NAPFA grade tables
+def compile_grade_tables(standards):
+    """Per (age, gender, test) cutoffs sorted ascending, for O(log k) grading and inverse lookups"""
+    tables = {}
+    for age, genders in standards.items():
+        for gender, tests in genders.items():
+            for test, (cutoffs, reverse) in tests.items():
+                ascending = sorted(cutoffs)
+                tables[(age, gender, test)] = {
+                    'cutoffs': ascending,
+                    'array': np.array(ascending, dtype=float),
+                    'reverse': reverse
+                }
+    return tables
+
+# Versioned standards file: {"current": version, "versions": {version: {age: {gender: {test:
+#   {"cutoffs": [grade 5 .. grade 1], "lower_is_better": bool}}}}}}
+# Older versions stay in the file so stored tests can be regraded with the rules they were taken under
+STANDARDS_FILE = 'napfa_standards.json'
+BUILTIN_STANDARDS_VERSION = 'builtin'
+
+def _parse_standards(raw):
+    """Convert one version from the file into the NAPFA_STANDARDS layout"""
+    standards = {}
+    for age, genders in raw.items():
+        for gender, tests in genders.items():
+            for test, rule in tests.items():
+                if gender not in ('m', 'f') or len(rule['cutoffs']) != 5:
+                    raise ValueError(f"Bad standard for age {age} {gender} {test}")
+                standards.setdefault(int(age), {}).setdefault(gender, {})[test] = [
+                    [float(c) for c in rule['cutoffs']], bool(rule['lower_is_better'])
+                ]
+    return standards
+
+@st.cache_resource(max_entries=4)
+def _compile_standards_file(path, mtime):
+    """Parse and compile every version in the standards file, once per modification time"""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    versions = {version: compile_grade_tables(_parse_standards(raw)) for version, raw in data['versions'].items()}
+    if data['current'] not in versions:
+        raise ValueError(f"Current version {data['current']} is not in the file")
+    return data['current'], versions
+
+@st.cache_resource
+def _compile_builtin_standards():
+    return compile_grade_tables(NAPFA_STANDARDS)
+
+def load_napfa_standards():
+    """Current version, compiled tables per version and any load error, picking up file edits without a restart"""
+    versions = {BUILTIN_STANDARDS_VERSION: _compile_builtin_standards()}
+    if not os.path.exists(STANDARDS_FILE):
+        return BUILTIN_STANDARDS_VERSION, versions, None
+    try:
+        current, file_versions = _compile_standards_file(STANDARDS_FILE, os.path.getmtime(STANDARDS_FILE))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return BUILTIN_STANDARDS_VERSION, versions, f"Could not load {STANDARDS_FILE} ({e}), using built-in standards"
+    versions.update(file_versions)
+    return current, versions, None
+
+# Resolved on every rerun, so a changed file applies to the next page load
+NAPFA_STANDARDS_VERSION, NAPFA_GRADE_TABLE_VERSIONS, NAPFA_STANDARDS_ERROR = load_napfa_standards()
+NAPFA_GRADE_TABLES = NAPFA_GRADE_TABLE_VERSIONS[NAPFA_STANDARDS_VERSION]
+NAPFA_AGES = sorted({age for age, _, _ in NAPFA_GRADE_TABLES})
+
+def grade_tables(version=None):
+    """Compiled tables for a standards version, the current one if unknown or not given"""
+    return NAPFA_GRADE_TABLE_VERSIONS.get(version, NAPFA_GRADE_TABLES)
+
+def has_napfa_standards(age, gender, version=None):
+    return (age, gender, 'SU') in grade_tables(version)
+
+def napfa_grade(age, gender, test, score, version=None):
+    """Grade 0-5 for one test score"""
+    table = grade_tables(version)[(age, gender, test)]
+    if table['reverse']:
+        # Lower is better: the grade counts cutoffs at or above the score
+        return len(table['cutoffs']) - bisect.bisect_left(table['cutoffs'], score)
+    # Higher is better: the grade counts cutoffs at or below the score
+    return bisect.bisect_right(table['cutoffs'], score)
+
+def napfa_grades(age, gender, test, scores, version=None):
+    """Vectorized napfa_grade for an array of scores"""
+    table = grade_tables(version)[(age, gender, test)]
+    scores = np.asarray(scores, dtype=float)
+    if table['reverse']:
+        return len(table['cutoffs']) - np.searchsorted(table['array'], scores, side='left')
+    return np.searchsorted(table['array'], scores, side='right')
+
+def napfa_score_needed(age, gender, test, grade, version=None):
+    """Weakest score that still earns `grade`, None for grade 0"""
+    if grade <= 0:
+        return None
+    table = grade_tables(version)[(age, gender, test)]
+    cutoffs = table['cutoffs']
+    return cutoffs[len(cutoffs) - grade] if table['reverse'] else cutoffs[grade - 1]
+
+def napfa_test_version(test):
+    """Standards version a stored test was graded under; tests saved before versioning used the built-in tables"""
+    return test.get('standards_version', BUILTIN_STANDARDS_VERSION)
+
+def regrade_napfa_test(test):
+    """Grades for a stored test recomputed under the standards version it was taken with"""
+    version = napfa_test_version(test)
+    # Class summaries saved before they kept the raw scores can only show the stored grades
+    if 'scores' not in test or not has_napfa_standards(test['age'], test['gender'], version):
+        return test['grades']
+    return {component: napfa_grade(test['age'], test['gender'], component, score, version)
+            for component, score in test['scores'].items()}
+
+def format_napfa_score(test, score):
+    """Display a raw test score in its usual units"""
+    if test == 'RUN':
+        minutes, seconds = divmod(int(round(score * 60)), 60)
+        return f"{minutes}:{seconds:02d}"
+    if test == 'SR':
+        return f"{score:.1f}s"
+    if test in ('SBJ', 'SAR'):
+        return f"{score:g} cm"
+    return f"{score:g}"
+
+def describe_next_grade(age, gender, test, grade, version=None):
+    """Target for the grade above `grade`, e.g. '≥ 32 for Grade 4' or '≤ 10:25 for Grade 4'"""
+    if grade >= 5:
+        return None
+    target = napfa_score_needed(age, gender, test, grade + 1, version)
+    sign = '≤' if grade_tables(version)[(age, gender, test)]['reverse'] else '≥'
+    return f"{sign} {format_napfa_score(test, target)} for Grade {grade + 1}"
+
+# Test components in display order
+NAPFA_COMPONENTS = ['SU', 'SBJ', 'SAR', 'PU', 'SR', 'RUN']
+
+# NAPFA medal rules: (medal, minimum total, minimum grade in every component, colour), best first
+NAPFA_MEDALS = [
+    ("🥇 Gold", 21, 3, "#FFD700"),
+    ("🥈 Silver", 15, 2, "#C0C0C0"),
+    ("🥉 Bronze", 9, 1, "#CD7F32")
+]
+
+def napfa_medal(total, min_grade):
+    """Medal name and colour for a NAPFA total and the lowest component grade"""
+    for medal, min_total, min_component, color in NAPFA_MEDALS:
+        if total >= min_total and min_grade >= min_component:
+            return medal, color
+    return "No Medal", SST_COLORS['gray']
+
+def napfa_medal_index(totals, min_grades):
+    """Vectorized napfa_medal: index into NAPFA_MEDALS per student, len(NAPFA_MEDALS) for no medal"""
+    totals = np.asarray(totals, dtype=float)
+    index = np.full(totals.shape, len(NAPFA_MEDALS))
+    for i in range(len(NAPFA_MEDALS) - 1, -1, -1):
+        _, min_total, min_component, _ = NAPFA_MEDALS[i]
+        index = np.where((totals >= min_total) & (np.asarray(min_grades) >= min_component), i, index)
+    return index
+
+# Medal Gap Optimizer
+# Cheapest set of grade improvements that satisfies a medal's total and minimum-grade rules
+MEDAL_GAP_COMPONENT_COST = 0.05  # Small charge per component touched, so fewer changes win ties
+
+def component_difficulty(napfa_history):
+    """Per-component cost multiplier from past tests: components the student has improved before are cheaper"""
+    difficulty = {component: 1.0 for component in NAPFA_COMPONENTS}
+    if len(napfa_history) < 2:
+        return difficulty
+    grades = np.array([[test['grades'].get(c, 0) for c in NAPFA_COMPONENTS] for test in napfa_history], dtype=float)
+    average_gain = np.clip(np.diff(grades, axis=0), 0, None).mean(axis=0)
+    return {component: 1.0 / (1.0 + gain) for component, gain in zip(NAPFA_COMPONENTS, average_gain)}
+
+def _grade_step_costs(test, difficulty):
+    """Cost of lifting each component from its current grade to every higher grade"""
+    age, gender, version = test['age'], test['gender'], napfa_test_version(test)
+    costs = {}
+    for component in NAPFA_COMPONENTS:
+        table = grade_tables(version)[(age, gender, component)]
+        spread = (table['cutoffs'][-1] - table['cutoffs'][0]) or 1.0
+        score = test['scores'][component]
+        current = test['grades'][component]
+        costs[component] = {current: 0.0}
+        for grade in range(current + 1, 6):
+            # Raw improvement needed, scaled by the width of the grade bands so units compare
+            needed = napfa_score_needed(age, gender, component, grade, version)
+            gap = max(score - needed if table['reverse'] else needed - score, 0.0) / spread
+            costs[component][grade] = (gap + MEDAL_GAP_COMPONENT_COST) * difficulty[component]
+    return costs
+
+def medal_gap_plan(test, min_total, min_grade, difficulty=None):
+    """Cheapest target grade per component for a medal tier, as a list of changes (empty if already there)"""
+    if difficulty is None:
+        difficulty = {component: 1.0 for component in NAPFA_COMPONENTS}
+    step_costs = _grade_step_costs(test, difficulty)
+    
+    # Knapsack over components: best[total] = (cost, chosen grades) using totals capped at min_total
+    best = {0: (0.0, ())}
+    for component in NAPFA_COMPONENTS:
+        options = [(grade, cost) for grade, cost in step_costs[component].items() if grade >= min_grade]
+        next_best = {}
+        for total, (cost, chosen) in best.items():
+            for grade, grade_cost in options:
+                key = min(total + grade, min_total)
+                candidate = (cost + grade_cost, chosen + (grade,))
+                if key not in next_best or candidate[0] < next_best[key][0]:
+                    next_best[key] = candidate
+        best = next_best
+    
+    if min_total not in best:
+        return None
+    
+    _, targets = best[min_total]
+    changes = []
+    for component, target in zip(NAPFA_COMPONENTS, targets):
+        current = test['grades'][component]
+        if target > current:
+            changes.append({
+                'component': component,
+                'from_grade': current,
+                'to_grade': target,
+                'score': test['scores'][component],
+                'target': napfa_score_needed(test['age'], test['gender'], component, target, napfa_test_version(test)),
+                'sign': '≤' if grade_tables(napfa_test_version(test))[(test['age'], test['gender'], component)]['reverse'] else '≥'
+            })
+    return changes
+
+def medal_gap_plans(test, napfa_history=()):
+    """Plans for every medal above the test's current one, best medal first"""
+    difficulty = component_difficulty(list(napfa_history))
+    current = napfa_medal_index([test['total']], [min(test['grades'].values())])[0]
+    plans = []
+    for medal, min_total, min_grade, _ in NAPFA_MEDALS[:current]:
+        plans.append((medal, medal_gap_plan(test, min_total, min_grade, difficulty)))
+    return plans
+
+def describe_gap_change(change):
+    return (f"{change['component']}: {format_napfa_score(change['component'], change['score'])} → "
+            f"{change['sign']} {format_napfa_score(change['component'], change['target'])} "
+            f"(Grade {change['from_grade']} → {change['to_grade']})")
+
+# NAPFA Norms
+# Fixed-bin histogram sketch per (age, gender, component) and school: constant size, and
+# sketches merge by adding counts, so a cohort is any set of schools summed together.
+# Each student contributes their latest test only, counted under the school it was taken at.
+NORMS_FILE = 'fittrack_norms.json'
+NORM_MIN_SAMPLES = 20
+
+# (lowest score, highest score, bin width, lower is better)
+NORM_BINS = {
+    'SU': (0, 100, 1, False),
+    'SBJ': (0, 350, 1, False),
+    'SAR': (0, 80, 1, False),
+    'PU': (0, 60, 1, False),
+    'SR': (5.0, 20.0, 0.1, True),
+    'RUN': (5.0, 25.0, 1 / 12, True)  # 5-second bins
+}
+
+def _norm_key(age, gender, component):
+    return f"{age}|{gender}|{component}"
+
+def _norm_bin(component, score):
+    low, high, width, _ = NORM_BINS[component]
+    bins = int(round((high - low) / width))
+    return min(max(int((score - low) / width + 1e-9), 0), bins - 1)
+
+def new_norm_sketch(component):
+    low, high, width, _ = NORM_BINS[component]
+    return [0] * int(round((high - low) / width))
+
+def load_norms():
+    if os.path.exists(NORMS_FILE):
+        with open(NORMS_FILE, 'r') as f:
+            return json.load(f)
+    return None
+
+def save_norms(norms):
+    norms['updated'] = datetime.now().strftime('%Y-%m-%d %H:%M')
+    with open(NORMS_FILE, 'w') as f:
+        json.dump(norms, f)
+
+def add_test_to_norms(norms, school, test, weight=1):
+    """Count a test into its school's sketches (weight -1 takes it back out)"""
+    sketches = norms['schools'].setdefault(school or 'Unknown', {})
+    for component, score in test.get('scores', {}).items():
+        if component not in NORM_BINS:
+            continue
+        key = _norm_key(test['age'], test['gender'], component)
+        sketch = sketches.setdefault(key, new_norm_sketch(component))
+        b = _norm_bin(component, score)
+        sketch[b] = max(sketch[b] + weight, 0)
+
+def merge_norm_sketches(norms, key, component, schools=None):
+    """Sum one sketch across the given schools (all schools if None)"""
+    merged = np.zeros(len(new_norm_sketch(component)), dtype=np.int64)
+    for school, sketches in norms['schools'].items():
+        if (schools is None or school in schools) and key in sketches:
+            merged += np.asarray(sketches[key], dtype=np.int64)
+    return merged
+
+def norm_percentile(norms, age, gender, component, score, schools=None):
+    """Share of the cohort this score beats (ties count half), with the cohort size; None if too few tests"""
+    counts = merge_norm_sketches(norms, _norm_key(age, gender, component), component, schools)
+    total = counts.sum()
+    if total < NORM_MIN_SAMPLES:
+        return None, int(total)
+    b = _norm_bin(component, score)
+    worse = counts[b + 1:].sum() if NORM_BINS[component][3] else counts[:b].sum()
+    return float((worse + 0.5 * counts[b]) / total * 100), int(total)
+
+def ordinal(n):
+    """1 -> '1st', 72 -> '72nd', 13 -> '13th'"""
+    suffix = 'th' if 10 <= n % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    return f"{n}{suffix}"
+
+def rebuild_napfa_norms(users_data):
+    """Batch job: recount every student's latest test from scratch"""
+    norms = {'schools': {}, 'updated': None}
+    for data in users_data.values():
+        if data.get('role') != 'teacher' and data.get('napfa_history'):
+            latest = data['napfa_history'][-1]
+            add_test_to_norms(norms, latest.get('school', data.get('school')), latest)
+    save_norms(norms)
+    return norms
+
+def get_norms(users_data):
+    """Stored norms, built by the batch job the first time they're needed"""
+    return load_norms() or rebuild_napfa_norms(users_data)
+
+def update_napfa_norms(user_data, entry, norms=None):
+    """Swap the student's previous latest test for the new one in the stored norms
+
+    Bulk callers pass the loaded `norms` and save them once after the last entry
+    """
+    batched = norms is not None
+    if not batched:
+        norms = load_norms()
+        if norms is None:
+            # The batch rebuild reads the history, which already holds this entry
+            rebuild_napfa_norms(st.session_state.users_data)
+            return
+    history = user_data.get('napfa_history', [])
+    if len(history) >= 2 and history[-2] is not entry:
+        previous = history[-2]
+        add_test_to_norms(norms, previous.get('school', user_data.get('school')), previous, weight=-1)
+    add_test_to_norms(norms, entry.get('school', user_data.get('school')), entry)
+    if not batched:
+        save_norms(norms)
+
+# Sleep Performance Model
+# Batch job joining each NAPFA test with the student's average sleep over the weeks before it, then
+# fitting total ~ sleep hours per cohort (everyone, by gender, by gender and age). Cohorts are
+# summarised by running sums, so the whole school is one grouped pass; the small result is stored
+# in a file and rebuilt in a background thread once it is a day old
+SLEEP_MODEL_FILE = 'fittrack_sleep_model.json'
+SLEEP_MODEL_MAX_AGE_HOURS = 24
+SLEEP_MODEL_WINDOW_DAYS = 28
+SLEEP_MODEL_MIN_NIGHTS = 7
+SLEEP_MODEL_MIN_SAMPLES = 10
+SLEEP_TARGET_HOURS = 8
+
+# Sleep bands reported alongside the fit: (label, lower bound, upper bound)
+SLEEP_BANDS = [("Under 7h", 0, 7), ("7-8h", 7, 8), ("8h+", 8, 24)]
+
+def sleep_before_tests(sleep_history, test_dates):
+    """Average hours and nights logged in the window before each test date"""
+    if not sleep_history:
+        return np.zeros(len(test_dates)), np.zeros(len(test_dates), dtype=int)
+    nights = sorted(sleep_history, key=lambda s: s['date'])
+    dates = np.array([s['date'] for s in nights], dtype='datetime64[D]')
+    hours = np.cumsum([0.0] + [s['hours'] + s.get('minutes', 0) / 60 for s in nights])
+    ends = np.array(test_dates, dtype='datetime64[D]')
+    first = np.searchsorted(dates, ends - SLEEP_MODEL_WINDOW_DAYS, side='left')
+    last = np.searchsorted(dates, ends, side='left')
+    count = last - first
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = np.where(count > 0, (hours[last] - hours[first]) / np.maximum(count, 1), 0.0)
+    return average, count
+
+def sleep_cohort_keys(age, gender):
+    """Most specific cohort first"""
+    return [f"{gender}|{age}", gender, 'all']
+
+def describe_sleep_cohort(key):
+    parts = key.split('|')
+    if parts[0] == 'all':
+        return "all students"
+    group = "boys" if parts[0] == 'm' else "girls"
+    return f"{group} aged {parts[1]}" if len(parts) > 1 else group
+
+def build_sleep_model(users_data):
+    """Batch job: fit NAPFA total against pre-test sleep for every cohort"""
+    sleep, totals, cohorts = [], [], []
+    for data in users_data.values():
+        if data.get('role') == 'teacher' or not data.get('napfa_history') or not data.get('sleep_history'):
+            continue
+        tests = data['napfa_history']
+        average, count = sleep_before_tests(data['sleep_history'], [test['date'] for test in tests])
+        for test, hours, nights in zip(tests, average, count):
+            if nights >= SLEEP_MODEL_MIN_NIGHTS:
+                sleep.append(hours)
+                totals.append(test['total'])
+                cohorts.append(sleep_cohort_keys(test['age'], test['gender']))
+    
+    x = np.array(sleep)
+    y = np.array(totals, dtype=float)
+    # Every sample counts once in each of its three cohorts
+    labels, index = np.unique(np.array(cohorts, dtype=str).reshape(-1), return_inverse=True)
+    x3, y3 = np.repeat(x, 3), np.repeat(y, 3)
+    sums = {name: np.bincount(index, weights=values, minlength=len(labels))
+            for name, values in (('n', np.ones_like(x3)), ('x', x3), ('y', y3),
+                                 ('xx', x3 * x3), ('xy', x3 * y3), ('yy', y3 * y3))}
+    band_of = np.digitize(x3, [low for _, low, _ in SLEEP_BANDS[1:]])
+    
+    model = {'computed': datetime.now().strftime('%Y-%m-%d %H:%M'), 'samples': len(x), 'cohorts': {}}
+    for i, key in enumerate(labels):
+        n = sums['n'][i]
+        sxx = sums['xx'][i] - sums['x'][i] ** 2 / n
+        sxy = sums['xy'][i] - sums['x'][i] * sums['y'][i] / n
+        syy = sums['yy'][i] - sums['y'][i] ** 2 / n
+        if n < SLEEP_MODEL_MIN_SAMPLES or sxx <= 1e-9:
+            continue
+        slope = sxy / sxx
+        residual = max(syy - slope * sxy, 0.0)
+        bands = {}
+        for b, (label, _, _) in enumerate(SLEEP_BANDS):
+            in_band = (index == i) & (band_of == b)
+            if in_band.any():
+                bands[label] = {'n': int(in_band.sum()), 'mean_total': float(y3[in_band].mean())}
+        model['cohorts'][str(key)] = {
+            'n': int(n),
+            'slope': float(slope),
+            'intercept': float((sums['y'][i] - slope * sums['x'][i]) / n),
+            'slope_se': float(np.sqrt(residual / (n - 2) / sxx)) if n > 2 else None,
+            'r': float(sxy / np.sqrt(sxx * syy)) if syy > 0 else 0.0,
+            'mean_sleep': float(sums['x'][i] / n),
+            'bands': bands
+        }
+    return model
+
+def load_sleep_model():
+    if os.path.exists(SLEEP_MODEL_FILE):
+        with open(SLEEP_MODEL_FILE, 'r') as f:
+            return json.load(f)
+    return None
+
+def save_sleep_model(model):
+    with open(SLEEP_MODEL_FILE, 'w') as f:
+        json.dump(model, f)
+
+@st.cache_resource
+def _sleep_model_job():
+    """Process-wide state so only one background rebuild runs at a time"""
+    return {'lock': threading.Lock(), 'running': False}
+
+def _rebuild_sleep_model_in_background():
+    job = _sleep_model_job()
+    try:
+        # Reads the saved users rather than a session's copy, which reruns keep mutating
+        save_sleep_model(build_sleep_model(load_users()))
+    except Exception:
+        logger.exception("Sleep model rebuild failed")
+    finally:
+        with job['lock']:
+            job['running'] = False
+
+def refresh_sleep_model(users_data, force=False):
+    """Stored model; a missing or day-old one is rebuilt in the background so no request waits on the batch job"""
+    if force:
+        model = build_sleep_model(users_data)
+        save_sleep_model(model)
+        return model
+    model = load_sleep_model()
+    if model and datetime.now() - datetime.strptime(model['computed'], '%Y-%m-%d %H:%M') < timedelta(hours=SLEEP_MODEL_MAX_AGE_HOURS):
+        return model
+    job = _sleep_model_job()
+    with job['lock']:
+        if not job['running']:
+            job['running'] = True
+            threading.Thread(target=_rebuild_sleep_model_in_background, daemon=True).start()
+    # Serve the stale model meanwhile; before the first build there is nothing to estimate from
+    return model or {'computed': None, 'samples': 0, 'cohorts': {}}
+
+def sleep_cohort_estimate(model, age, gender):
+    """(cohort key, fitted cohort) for the most specific cohort with enough data, or (None, None)"""
+    for key in sleep_cohort_keys(age, gender):
+        if key in model['cohorts']:
+            return key, model['cohorts'][key]
+    return None, None
+
+# NAPFA Trend Model
+# Ordinary least squares per student on test date (days from today), for the total and each
+# component grade, computed for many students at once with padded arrays
+
+# Two-sided 95% Student t quantiles for 1-30 degrees of freedom, normal beyond
+T_QUANTILES_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                  2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                  2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+def _t_quantile_95(dof):
+    dof = np.asarray(dof)
+    table = np.array(T_QUANTILES_95)
+    return np.where(dof > len(table), 1.96, table[np.clip(dof, 1, len(table)) - 1])
+
+def fit_napfa_trends(histories):
+    """Fit a line through every student's tests; histories is a list of napfa_history lists"""
+    targets = ['total'] + NAPFA_COMPONENTS
+    n = len(histories)
+    m = max((len(h) for h in histories), default=0)
+    today = datetime.now().date()
+    
+    x = np.full((n, m), np.nan)
+    y = np.zeros((n, m, len(targets)))
+    for i, history in enumerate(histories):
+        for j, test in enumerate(history):
+            x[i, j] = (datetime.strptime(test['date'], '%Y-%m-%d').date() - today).days
+            y[i, j] = [test['total']] + [test['grades'].get(c, 0) for c in NAPFA_COMPONENTS]
+    
+    present = ~np.isnan(x)
+    count = present.sum(axis=1)
+    safe_count = np.maximum(count, 1)
+    x_mean = np.where(present, x, 0).sum(axis=1) / safe_count
+    dx = np.where(present, x - x_mean[:, None], 0)
+    sxx = (dx ** 2).sum(axis=1)
+    
+    y_mean = np.where(present[..., None], y, 0).sum(axis=1) / safe_count[:, None]
+    dy = np.where(present[..., None], y - y_mean[:, None, :], 0)
+    # Tests all on one day give no slope; fall back to a flat line through their mean
+    has_trend = sxx > 0
+    slope = np.where(has_trend[:, None], (dx[..., None] * dy).sum(axis=1) / np.where(has_trend, sxx, 1)[:, None], 0)
+    intercept = y_mean - slope * x_mean[:, None]
+    
+    residuals = np.where(present[..., None], y - (intercept[:, None, :] + slope[:, None, :] * np.nan_to_num(x)[..., None]), 0)
+    dof = count - 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        residual_var = np.where((dof > 0)[:, None], (residuals ** 2).sum(axis=1) / np.maximum(dof, 1)[:, None], np.nan)
+    
+    return {
+        'targets': targets,
+        'count': count,
+        'has_trend': has_trend,
+        'x_mean': x_mean,
+        'sxx': sxx,
+        'slope': slope,
+        'intercept': intercept,
+        'residual_var': residual_var,
+        'dof': dof
+    }
+
+def predict_napfa_trends(fit, days_ahead):
+    """Predicted value and 95% prediction interval at `days_ahead` from today, each (students, targets)"""
+    upper_bounds = np.array([30] + [5] * (len(fit['targets']) - 1), dtype=float)
+    prediction = fit['intercept'] + fit['slope'] * days_ahead
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        leverage = 1 + 1 / np.maximum(fit['count'], 1) + (days_ahead - fit['x_mean']) ** 2 / np.where(fit['sxx'] > 0, fit['sxx'], np.nan)
+        half_width = _t_quantile_95(fit['dof'])[:, None] * np.sqrt(fit['residual_var'] * leverage[:, None])
+    
+    # Fewer than three tests leaves no residual spread to estimate: interval is NaN
+    return (np.clip(prediction, 0, upper_bounds),
+            np.clip(prediction - half_width, 0, upper_bounds),
+            np.clip(prediction + half_width, 0, upper_bounds))
+
+def days_to_medal(fit, min_total, min_grade):
+    """Days from today until the fitted lines meet a medal's total and every minimum grade
+    (0 if already there, inf if a needed line isn't rising)"""
+    needed = np.array([min_total] + [min_grade] * (len(fit['targets']) - 1), dtype=float)
+    now = fit['intercept']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days = np.where(now >= needed, 0.0, np.where(fit['slope'] > 0, (needed - now) / fit['slope'], np.inf))
+    return days.max(axis=1)
+
+# Fitness-Fatigue Model
+# Banister impulse-response model: performance = p0 + k1 * fitness - k2 * fatigue, where fitness and
+# fatigue are the daily training load passed through exponential decays with time constants tau1 > tau2.
+# The time constants come from a grid search; for each pair p0, k1 and k2 are a linear least-squares fit
+# to the NAPFA totals. Every student in a batch shares one calendar so the whole class fits at once
+BANISTER_FITNESS_TAUS = [20, 25, 30, 35, 40, 45, 50, 55, 60]
+BANISTER_FATIGUE_TAUS = [3, 6, 9, 12, 15, 18]
+BANISTER_DEFAULT = (42, 7, 1.0, 2.0)  # tau1, tau2, k1, k2 from the literature, used until a student can be fitted
+BANISTER_MIN_TESTS = 4
+BANISTER_RIDGE = 0.01
+TAPER_LENGTHS = [0, 3, 5, 7, 10, 14, 21]
+TAPER_CUTS = [0.3, 0.5, 0.7, 0.9]
+
+def _impulse_response(loads, taus):
+    """Exponentially decayed sums of each row of daily loads, shape (taus, students, days)"""
+    taus = np.asarray(taus, dtype=float)[:, None]
+    decay = np.exp(-1 / taus)
+    response = np.zeros((len(taus),) + loads.shape)
+    level = np.zeros((len(taus), loads.shape[0]))
+    for day in range(loads.shape[1]):
+        level = level * decay + loads[:, day] / taus
+        response[:, :, day] = level
+    return response
+
+def fit_banister(students):
+    """Fit the model for (exercises, napfa_history) pairs; students without enough tests keep the defaults"""
+    n = len(students)
+    today = datetime.now().date()
+    first_days = [datetime.strptime(min(e['date'] for e in exercises), '%Y-%m-%d').date()
+                  for exercises, _ in students if exercises]
+    start = min(first_days + [today])
+    days = (today - start).days + 1
+    
+    loads = np.zeros((n, days))
+    recent_load = np.zeros(n)
+    m = max((len(history) for _, history in students), default=0)
+    test_days = np.zeros((n, m), dtype=int)
+    totals = np.zeros((n, m))
+    tested = np.zeros((n, m), dtype=bool)
+    for i, (exercises, history) in enumerate(students):
+        if exercises:
+            offsets = np.array([(datetime.strptime(e['date'], '%Y-%m-%d').date() - start).days for e in exercises])
+            keep = (offsets >= 0) & (offsets < days)
+            np.add.at(loads[i], offsets[keep], np.array([session_load(e) for e in exercises])[keep])
+        recent_load[i] = loads[i, -CHRONIC_LOAD_DAYS:].sum() / CHRONIC_LOAD_DAYS
+        for j, test in enumerate(history):
+            offset = (datetime.strptime(test['date'], '%Y-%m-%d').date() - start).days
+            if 0 <= offset < days:
+                test_days[i, j], totals[i, j], tested[i, j] = offset, test['total'], True
+    
+    taus = sorted(set(BANISTER_FITNESS_TAUS) | set(BANISTER_FATIGUE_TAUS) | set(BANISTER_DEFAULT[:2]))
+    response = _impulse_response(loads, taus)
+    at_tests = np.take_along_axis(response, np.broadcast_to(test_days, (len(taus), n, m)), axis=2)
+    
+    pairs = [(a, b) for a in BANISTER_FITNESS_TAUS for b in BANISTER_FATIGUE_TAUS if a > b]
+    fitness = at_tests[[taus.index(a) for a, _ in pairs]].transpose(1, 0, 2)  # (students, pairs, tests)
+    fatigue = at_tests[[taus.index(b) for _, b in pairs]].transpose(1, 0, 2)
+    
+    # Normal equations for [p0, k1, k2] against [1, fitness, -fatigue], batched over students and pairs
+    X = np.stack([np.ones_like(fitness), fitness, -fatigue], axis=-1) * tested[:, None, :, None]
+    y = totals * tested
+    XtX = np.einsum('spmi,spmj->spij', X, X)
+    Xty = np.einsum('spmi,sm->spi', X, y)
+    # A small ridge on k1 and k2, scaled to the spread of each feature across the student's tests,
+    # keeps four or five tests from producing wild coefficients
+    count = np.maximum(XtX[..., 0, 0], 1)
+    for k in (1, 2):
+        XtX[..., k, k] += BANISTER_RIDGE * (XtX[..., k, k] - XtX[..., 0, k] ** 2 / count)
+    XtX += 1e-9 * np.eye(3)
+    coef = np.linalg.solve(XtX, Xty[..., None])[..., 0]
+    sse = ((np.einsum('spmi,spi->spm', X, coef) - y[:, None, :]) ** 2).sum(axis=2)
+    sse = np.where((coef[..., 1] >= 0) & (coef[..., 2] >= 0), sse, np.inf)
+    
+    best = sse.argmin(axis=1)
+    rows = np.arange(n)
+    fitted = (tested.sum(axis=1) >= BANISTER_MIN_TESTS) & np.isfinite(sse[rows, best])
+    best_pairs = np.array(pairs)[best]
+    tau_fitness = np.where(fitted, best_pairs[:, 0], BANISTER_DEFAULT[0])
+    tau_fatigue = np.where(fitted, best_pairs[:, 1], BANISTER_DEFAULT[1])
+    
+    return {
+        'fitted': fitted,
+        'tests': tested.sum(axis=1),
+        'p0': np.where(fitted, coef[rows, best, 0], np.nan),
+        'k1': np.where(fitted, coef[rows, best, 1], BANISTER_DEFAULT[2]),
+        'k2': np.where(fitted, coef[rows, best, 2], BANISTER_DEFAULT[3]),
+        'tau_fitness': tau_fitness,
+        'tau_fatigue': tau_fatigue,
+        'rmse': np.where(fitted, np.sqrt(sse[rows, best] / np.maximum(tested.sum(axis=1), 1)), np.nan),
+        'fitness': response[[taus.index(t) for t in tau_fitness], rows, -1],
+        'fatigue': response[[taus.index(t) for t in tau_fatigue], rows, -1],
+        'recent_load': recent_load
+    }
+
+def banister_form(model):
+    """Training effect (k1 * fitness - k2 * fatigue) today; in NAPFA points for fitted students"""
+    return model['k1'] * model['fitness'] - model['k2'] * model['fatigue']
+
+def banister_forecast(model, i, future_loads):
+    """Form on test day for student i after each row of planned daily loads (plans, days until the test)"""
+    future_loads = np.atleast_2d(future_loads)
+    horizon = future_loads.shape[1]
+    effect = np.zeros(future_loads.shape[0])
+    for tau, k, level in ((model['tau_fitness'][i], model['k1'][i], model['fitness'][i]),
+                          (model['tau_fatigue'][i], -model['k2'][i], model['fatigue'][i])):
+        # Day h of the plan is horizon - h days before the test
+        weights = np.exp(-(horizon - np.arange(horizon)) / tau) / tau
+        effect += k * (level * np.exp(-(horizon + 1) / tau) + future_loads @ weights)
+    return effect
+
+def plan_taper(model, i, days_to_test):
+    """Best taper before a test `days_to_test` days away, holding the recent load until it starts"""
+    plan_days = max(days_to_test - 1, 0)
+    plans = [(0, 0.0)] + [(length, cut) for length in TAPER_LENGTHS[1:] if length <= plan_days for cut in TAPER_CUTS]
+    future = np.full((len(plans), plan_days), model['recent_load'][i])
+    for row, (length, cut) in enumerate(plans):
+        if length:
+            future[row, plan_days - length:] *= 1 - cut
+    
+    effect = banister_forecast(model, i, future)
+    baseline = model['p0'][i] if model['fitted'][i] else 0.0
+    predicted = baseline + effect
+    if model['fitted'][i]:
+        predicted = np.clip(predicted, 0, 30)
+    best = int(np.argmax(predicted))
+    return {
+        'days': plans[best][0],
+        'cut': plans[best][1],
+        'predicted': float(predicted[best]),
+        'no_taper': float(predicted[0]),
+        'plans': pd.DataFrame([{'Taper (days)': length, 'Load Cut': f"{cut:.0%}", 'Predicted': value}
+                               for (length, cut), value in zip(plans, predicted)])
+    }
 
 # Body Type Calculator
 def calculate_body_type(weight, height):
@@ -325,7 +1028,7 @@ def generate_ai_response(question, user_data):
     if 'napfa' in question_lower or 'pull' in question_lower or 'sit up' in question_lower or 'run' in question_lower:
         if has_napfa:
             latest = user_data['napfa_history'][-1]
-            weak_tests = [test for test, grade in latest['grades'].items() if grade < 3]
+            weak_tests = [test for test, grade in regrade_napfa_test(latest).items() if grade < 3]
             if weak_tests:
                 return f"Based on your latest NAPFA test, I see you need work on: {', '.join(weak_tests)}. Check the 'Workout Recommendations' tab for specific exercises! Focus on consistency - train each weak area 3-4x per week."
             else:
@@ -497,6 +1200,8 @@ def login_page():
                         break
             
             if user_found:
+                if settle_friend_challenges(st.session_state.users_data, user_found):
+                    save_users(st.session_state.users_data)
                 st.session_state.logged_in = True
                 st.session_state.username = user_found
                 st.rerun()
@@ -542,10 +1247,13 @@ def login_page():
                 school = "School of Science and Technology"
                 st.text_input("School", value=school, disabled=True, key="reg_school_teacher")
                 department = st.text_input("Department (Optional)", placeholder="e.g., PE Department", key="reg_department")
+                hod_requested = st.checkbox("Request Head of Department access (school-wide analytics, needs approval)",
+                                            value=False, key="reg_is_hod")
         
         if role == "Student":
             st.write("### Privacy Settings")
             show_on_leaderboards = st.checkbox("Show me on public leaderboards", value=False, key="reg_leaderboard")
+            share_activity = st.checkbox("Share my activity with friends", value=False, key="reg_share_activity")
             
             st.write("### Join a Class (Optional)")
             class_code = st.text_input("Class Code", placeholder="Enter code from your teacher", key="reg_class_code")
@@ -585,6 +1293,7 @@ def login_page():
                         'school': school,
                         'class': class_name,
                         'show_on_leaderboards': show_on_leaderboards,
+                        'share_activity': share_activity,
                         'created': datetime.now().isoformat(),
                         'bmi_history': [],
                         'napfa_history': [],
@@ -595,6 +1304,7 @@ def login_page():
                         'saved_workout_plan': None,
                         'friends': [],
                         'friend_requests': [],
+                        'activity_feed': [],
                         'badges': [],
                         'level': 'Novice',
                         'total_points': 0,
@@ -602,6 +1312,8 @@ def login_page():
                         'login_streak': 0,
                         'active_challenges': [],
                         'completed_challenges': [],
+                        'challenge_progress': {},
+                        'friend_challenges': [],
                         'teacher_class': None  # Will be set when joining a class
                     }
                     
@@ -637,10 +1349,14 @@ def login_page():
                         'gender': 'm' if gender == "Male" else 'f',
                         'school': school,
                         'department': department,
+                        'hod_requested': hod_requested,
                         'created': datetime.now().isoformat(),
                         'class_code': class_code,
                         'students': [],  # List of student usernames
                         'classes_created': [],  # Can create multiple classes
+                        'custom_challenges': [],  # Weekly challenges set for the class
+                        'at_risk': {},  # Stored at-risk flag tables ('class' and 'school')
+                        'saved_queries': [],  # Student query builder filters
                         'last_login': datetime.now().isoformat()
                     }
                 
@@ -691,6 +1407,7 @@ def bmi_calculator():
             'height': height,
             'category': category
         })
+        apply_log_event(st.session_state.username, user_data, 'bmi', user_data['bmi_history'][-1])
         update_user_data(user_data)
         
         # Display results
@@ -720,13 +1437,16 @@ def napfa_calculator():
         gender = st.selectbox("Gender", ["Male", "Female"], 
                             index=0 if user_data['gender'] == 'm' else 1)
     with col2:
-        age = st.number_input("Age", min_value=12, max_value=16, value=user_data['age'])
+        age = st.number_input("Age", min_value=NAPFA_AGES[0], max_value=NAPFA_AGES[-1],
+                              value=min(max(user_data['age'], NAPFA_AGES[0]), NAPFA_AGES[-1]))
     
-    if age not in NAPFA_STANDARDS:
-        st.error("Age must be between 12-16")
-        return
+    if NAPFA_STANDARDS_ERROR:
+        st.warning(NAPFA_STANDARDS_ERROR)
     
     gender_key = 'm' if gender == "Male" else 'f'
+    if not has_napfa_standards(age, gender_key):
+        st.error(f"No NAPFA standards for age {age} ({gender})")
+        return
     
     st.subheader("Enter Your Scores")
     
@@ -747,8 +1467,6 @@ def napfa_calculator():
             time_parts = run_time.split(':')
             run_minutes = int(time_parts[0]) + int(time_parts[1]) / 60
             
-            standards = NAPFA_STANDARDS[age][gender_key]
-            
             scores = {
                 'SU': situps,
                 'SBJ': broadjump,
@@ -772,24 +1490,13 @@ def napfa_calculator():
             min_grade = 5
             
             for test in scores:
-                grade = calc_grade(scores[test], standards[test][0], standards[test][1])
+                grade = napfa_grade(age, gender_key, test, scores[test])
                 grades[test] = grade
                 total += grade
                 min_grade = min(min_grade, grade)
             
             # Determine medal
-            if total >= 21 and min_grade >= 3:
-                medal = "🥇 Gold"
-                medal_color = "#FFD700"
-            elif total >= 15 and min_grade >= 2:
-                medal = "🥈 Silver"
-                medal_color = "#C0C0C0"
-            elif total >= 9 and min_grade >= 1:
-                medal = "🥉 Bronze"
-                medal_color = "#CD7F32"
-            else:
-                medal = "No Medal"
-                medal_color = SST_COLORS['gray']
+            medal, medal_color = napfa_medal(total, min_grade)
             
             # Save to history
             user_data['napfa_history'].append({
@@ -799,8 +1506,11 @@ def napfa_calculator():
                 'scores': scores,
                 'grades': grades,
                 'total': total,
-                'medal': medal
+                'medal': medal,
+                'standards_version': NAPFA_STANDARDS_VERSION,
+                'school': user_data.get('school')
             })
+            apply_log_event(st.session_state.username, user_data, 'napfa', user_data['napfa_history'][-1])
             update_user_data(user_data)
             
             # Display results
@@ -810,8 +1520,9 @@ def napfa_calculator():
             for test, grade in grades.items():
                 results_data.append({
                     'Test': test_names[test],
-                    'Score': scores[test],
-                    'Grade': grade
+                    'Score': format_napfa_score(test, scores[test]),
+                    'Grade': grade,
+                    'Next Grade': describe_next_grade(age, gender_key, test, grade) or "🏆 Top grade"
                 })
             
             df = pd.DataFrame(results_data)
@@ -827,6 +1538,33 @@ def napfa_calculator():
             
         except Exception as e:
             st.error(f"Error calculating grades: {str(e)}")
+    
+    # Compare the latest test against other students of the same age and gender
+    user_data = get_user_data()
+    if user_data.get('napfa_history'):
+        latest = user_data['napfa_history'][-1]
+        st.write("")
+        st.subheader("📊 How You Compare")
+        
+        scope = st.radio("Compare with", ["My school", "All schools"], horizontal=True, key="norm_scope")
+        schools = [user_data.get('school') or 'Unknown'] if scope == "My school" else None
+        norms = get_norms(st.session_state.users_data)
+        
+        compare_rows = []
+        for test, name in [('SU', 'Sit-Ups'), ('SBJ', 'Standing Broad Jump'), ('SAR', 'Sit and Reach'),
+                           ('PU', 'Pull-Ups'), ('SR', 'Shuttle Run'), ('RUN', '2.4km Run')]:
+            percentile, cohort = norm_percentile(norms, latest['age'], latest['gender'], test,
+                                                 latest['scores'][test], schools)
+            compare_rows.append({
+                'Test': name,
+                'Your Score': format_napfa_score(test, latest['scores'][test]),
+                'Percentile': ordinal(round(percentile)) if percentile is not None else "Not enough data",
+                'Students Compared': cohort
+            })
+        
+        st.dataframe(pd.DataFrame(compare_rows), use_container_width=True, hide_index=True)
+        st.caption(f"Based on each student's latest test, age {latest['age']} {'boys' if latest['gender'] == 'm' else 'girls'}. "
+                   f"Percentiles need at least {NORM_MIN_SAMPLES} students.")
 
 # Sleep Tracker
 def sleep_tracker():
@@ -879,6 +1617,7 @@ def sleep_tracker():
                 'minutes': minutes,
                 'quality': quality
             })
+            apply_log_event(st.session_state.username, user_data, 'sleep', user_data['sleep_history'][-1])
             update_user_data(user_data)
             
             # Display results
@@ -928,6 +1667,7 @@ def exercise_logger():
                     'intensity': intensity,
                     'notes': notes
                 })
+                apply_log_event(st.session_state.username, user_data, 'exercise', user_data['exercises'][0])
                 update_user_data(user_data)
                 st.success("Exercise logged successfully!")
                 st.rerun()
@@ -938,7 +1678,9 @@ def exercise_logger():
     user_data = get_user_data()
     if user_data['exercises']:
         st.subheader("Recent Exercises")
-        df = pd.DataFrame(user_data['exercises'])
+        # Exercises are stored newest first, so a page is a plain slice
+        start, end = paginate(len(user_data['exercises']), "exercise_history_page", page_size=25)
+        df = pd.DataFrame(user_data['exercises'][start:end])
         st.dataframe(df[['date', 'name', 'duration', 'intensity']], use_container_width=True, hide_index=True)
         
         # Show summary chart
@@ -1196,6 +1938,758 @@ def update_login_streak(user_data):
     user_data['last_login'] = datetime.now().isoformat()
     return user_data
 
+# Weekly Challenge Engine
+# Built-in challenges; teachers can add their own for their class
+WEEKLY_CHALLENGES = [
+    {
+        'name': 'Workout Warrior',
+        'description': 'Complete 5 workouts this week',
+        'target': 5,
+        'type': 'workouts',
+        'points': 50
+    },
+    {
+        'name': 'Cardio King',
+        'description': 'Total 150 minutes of exercise this week',
+        'target': 150,
+        'type': 'minutes',
+        'points': 60
+    },
+    {
+        'name': 'Early Bird',
+        'description': 'Log 7 days of sleep tracking',
+        'target': 7,
+        'type': 'sleep',
+        'points': 40
+    }
+]
+
+CHALLENGE_TYPES = {
+    'workouts': 'Workouts logged',
+    'minutes': 'Minutes of exercise',
+    'sleep': 'Days of sleep tracked'
+}
+
+# Number of weekly counter buckets kept per user
+CHALLENGE_PERIODS_KEPT = 8
+
+def challenge_period_key(date_str=None):
+    """Return the ISO week key (e.g. 2024-W07) for a YYYY-MM-DD date, default today"""
+    date = datetime.strptime(date_str, '%Y-%m-%d') if date_str else datetime.now()
+    year, week, _ = date.isocalendar()
+    return f"{year}-W{week:02d}"
+
+def _new_period_counters():
+    return {'workouts': 0, 'minutes': 0, 'sleep': 0, 'sleep_days': [], 'completed': []}
+
+def _bump_challenge_counters(progress, kind, entry):
+    """Add one log entry to its week's counters"""
+    counters = progress.setdefault(challenge_period_key(entry['date']), _new_period_counters())
+
+    if kind == 'exercise':
+        counters['workouts'] += 1
+        counters['minutes'] += entry.get('duration', 0)
+    elif kind == 'sleep':
+        # Early Bird counts days, not entries
+        if entry['date'] not in counters['sleep_days']:
+            counters['sleep_days'].append(entry['date'])
+            counters['sleep'] += 1
+
+def _prune_challenge_periods(progress):
+    """Drop the oldest weekly buckets so the record stays small"""
+    # ISO week keys sort chronologically as strings
+    for period in sorted(progress)[:-CHALLENGE_PERIODS_KEPT]:
+        del progress[period]
+
+def rebuild_challenge_counters(user_data):
+    """Rebuild weekly challenge counters from the full logs (one-off migration)"""
+    oldest_kept = (datetime.now() - timedelta(weeks=CHALLENGE_PERIODS_KEPT)).strftime('%Y-%m-%d')
+    progress = {}
+
+    for exercise in user_data.get('exercises', []):
+        if exercise['date'] >= oldest_kept:
+            _bump_challenge_counters(progress, 'exercise', exercise)
+    for sleep in user_data.get('sleep_history', []):
+        if sleep['date'] >= oldest_kept:
+            _bump_challenge_counters(progress, 'sleep', sleep)
+
+    # Keep completions already recorded for these weeks
+    for completed in user_data.get('completed_challenges', []):
+        period = completed.get('period') or challenge_period_key(completed['completed_date'])
+        if period in progress:
+            progress[period]['completed'].append(completed['name'])
+
+    _prune_challenge_periods(progress)
+    user_data['challenge_progress'] = progress
+    return progress
+
+def get_period_counters(user_data, period=None):
+    """Return the challenge counters for a week (defaults to the current week), without changing the record"""
+    progress = user_data.get('challenge_progress')
+    if progress is None:
+        # Not migrated yet: count from the logs on a copy, the next log event stores the counters
+        progress = rebuild_challenge_counters(dict(user_data))
+    return progress.get(period or challenge_period_key(), _new_period_counters())
+
+def get_weekly_challenges(user_data, all_users):
+    """Built-in challenges plus any set by the student's teacher"""
+    challenges = list(WEEKLY_CHALLENGES)
+    teacher = all_users.get(user_data.get('teacher_class') or '', {})
+    challenges.extend(teacher.get('custom_challenges', []))
+    return challenges
+
+def complete_challenge(user_data, challenge, period=None):
+    """Mark a challenge as completed for a week and award its points"""
+    period = period or challenge_period_key()
+    progress = user_data.setdefault('challenge_progress', {})
+    counters = progress.setdefault(period, _new_period_counters())
+    counters['completed'].append(challenge['name'])
+
+    user_data.setdefault('completed_challenges', []).append({
+        'name': challenge['name'],
+        'period': period,
+        'completed_date': datetime.now().strftime('%Y-%m-%d'),
+        'points': challenge['points']
+    })
+    user_data['total_points'] = user_data.get('total_points', 0) + challenge['points']
+
+# Training Load
+# Each workout scores duration x intensity weight. Acute (7-day) and chronic (28-day) loads are
+# exponentially weighted daily averages kept on the user record and updated per workout, so the
+# acute:chronic workload ratio (ACWR) never needs a pass over the whole history
+TRAINING_LOAD_WEIGHTS = {'Low': 3, 'Medium': 5, 'High': 8}  # Effort per minute, session-RPE style
+ACUTE_LOAD_DAYS = 7
+CHRONIC_LOAD_DAYS = 28
+ACUTE_DECAY = 2 / (ACUTE_LOAD_DAYS + 1)
+CHRONIC_DECAY = 2 / (CHRONIC_LOAD_DAYS + 1)
+TRAINING_LOAD_HISTORY_DAYS = 90
+
+# Upper bound of each ACWR band with its label and colour
+ACWR_ZONES = [
+    (0.8, "Under-training", "#2196f3"),
+    (1.3, "Sweet spot", "#4caf50"),
+    (1.5, "Caution", "#ff9800"),
+    (float('inf'), "Danger zone", "#f44336")
+]
+
+def session_load(entry):
+    return entry.get('duration', 0) * TRAINING_LOAD_WEIGHTS.get(entry.get('intensity'), TRAINING_LOAD_WEIGHTS['Medium'])
+
+def _new_training_load():
+    return {'date': None, 'first': None, 'acute': 0.0, 'chronic': 0.0, 'history': {}}
+
+def _advance_training_load(state, day):
+    """Decay the loads day by day up to `day`, recording each day's values"""
+    current = datetime.strptime(state['date'], '%Y-%m-%d')
+    target = datetime.strptime(day, '%Y-%m-%d')
+    while current < target:
+        current += timedelta(days=1)
+        state['acute'] *= 1 - ACUTE_DECAY
+        state['chronic'] *= 1 - CHRONIC_DECAY
+        state['history'][current.strftime('%Y-%m-%d')] = [round(state['acute'], 3), round(state['chronic'], 3)]
+    state['date'] = day
+
+def add_session_load(state, day, load):
+    """Add one workout's load on `day`; earlier days are folded in by their decayed contribution"""
+    if state['date'] is None:
+        state['date'] = state['first'] = day
+    elif day < state['first']:
+        # Nothing was logged before the old first day, so those days start from zero
+        current = datetime.strptime(day, '%Y-%m-%d')
+        while current.strftime('%Y-%m-%d') < state['first']:
+            state['history'][current.strftime('%Y-%m-%d')] = [0.0, 0.0]
+            current += timedelta(days=1)
+        state['first'] = day
+    
+    if day >= state['date']:
+        _advance_training_load(state, day)
+    
+    # The averages are linear in the loads, so a workout on day d adds decay^(t - d) of its weight to every later day t
+    for recorded, values in state['history'].items():
+        if recorded >= day:
+            days_after = (datetime.strptime(recorded, '%Y-%m-%d') - datetime.strptime(day, '%Y-%m-%d')).days
+            values[0] = round(values[0] + ACUTE_DECAY * (1 - ACUTE_DECAY) ** days_after * load, 3)
+            values[1] = round(values[1] + CHRONIC_DECAY * (1 - CHRONIC_DECAY) ** days_after * load, 3)
+    days_after = (datetime.strptime(state['date'], '%Y-%m-%d') - datetime.strptime(day, '%Y-%m-%d')).days
+    state['acute'] += ACUTE_DECAY * (1 - ACUTE_DECAY) ** days_after * load
+    state['chronic'] += CHRONIC_DECAY * (1 - CHRONIC_DECAY) ** days_after * load
+    if day == state['date']:
+        state['history'][day] = [round(state['acute'], 3), round(state['chronic'], 3)]
+    
+    cutoff = (datetime.strptime(state['date'], '%Y-%m-%d') - timedelta(days=TRAINING_LOAD_HISTORY_DAYS)).strftime('%Y-%m-%d')
+    for recorded in [d for d in state['history'] if d < cutoff]:
+        del state['history'][recorded]
+
+def rebuild_training_load(user_data):
+    """Recompute the training load state from every logged workout"""
+    state = _new_training_load()
+    for entry in sorted(user_data.get('exercises', []), key=lambda e: e['date']):
+        add_session_load(state, entry['date'], session_load(entry))
+    user_data['training_load'] = state
+    return state
+
+def update_training_load(user_data, entry):
+    if 'training_load' not in user_data:
+        # The rebuild already includes this entry
+        rebuild_training_load(user_data)
+    else:
+        add_session_load(user_data['training_load'], entry['date'], session_load(entry))
+
+def get_training_load(user_data):
+    """Stored state, built in memory for users who haven't logged since loads were added"""
+    return user_data.get('training_load') or rebuild_training_load(dict(user_data))
+
+def training_load_today(state):
+    """(acute, chronic) decayed to today"""
+    if state['date'] is None:
+        return 0.0, 0.0
+    idle_days = max((datetime.now() - datetime.strptime(state['date'], '%Y-%m-%d')).days, 0)
+    return (state['acute'] * (1 - ACUTE_DECAY) ** idle_days,
+            state['chronic'] * (1 - CHRONIC_DECAY) ** idle_days)
+
+def acwr(acute, chronic):
+    return acute / chronic if chronic > 0 else None
+
+def acwr_zone(ratio):
+    for upper, label, color in ACWR_ZONES:
+        if ratio < upper:
+            return label, color
+    return ACWR_ZONES[-1][1], ACWR_ZONES[-1][2]
+
+def acwr_history(state, days=60):
+    """Daily acute load, chronic load and ACWR for the last `days` days, extended to today"""
+    if state['date'] is None:
+        return pd.DataFrame(columns=['Acute Load', 'Chronic Load', 'ACWR'])
+    rows = dict(state['history'])
+    acute, chronic = state['acute'], state['chronic']
+    day = datetime.strptime(state['date'], '%Y-%m-%d')
+    while day.date() < datetime.now().date():
+        day += timedelta(days=1)
+        acute *= 1 - ACUTE_DECAY
+        chronic *= 1 - CHRONIC_DECAY
+        rows[day.strftime('%Y-%m-%d')] = [acute, chronic]
+    
+    df = pd.DataFrame.from_dict(rows, orient='index', columns=['Acute Load', 'Chronic Load']).sort_index()
+    df = df[df.index >= (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')]
+    df['ACWR'] = df['Acute Load'] / df['Chronic Load'].where(df['Chronic Load'] > 0)
+    return df
+
+# Log Event Hooks
+def apply_log_event(username, user_data, kind, entry, norms=None):
+    """Update maintained counters after a new log entry has been added to user_data"""
+    user_data['history_version'] = user_data.get('history_version', 0) + 1
+    invalidate_insights(username)
+    
+    if 'challenge_progress' not in user_data:
+        # First event since the counters were added; the rebuild already includes this entry
+        rebuild_challenge_counters(user_data)
+    elif kind in ('exercise', 'sleep'):
+        _bump_challenge_counters(user_data['challenge_progress'], kind, entry)
+        _prune_challenge_periods(user_data['challenge_progress'])
+    
+    if kind in ('exercise', 'napfa'):
+        update_class_summary(st.session_state.users_data, username, kind, entry)
+        record_challenge_event(st.session_state.users_data, username, kind, entry)
+    
+    if kind == 'exercise':
+        update_training_load(user_data, entry)
+    
+    if kind == 'napfa':
+        update_napfa_norms(user_data, entry, norms)
+    
+    if kind in ACTIVITY_EVENT_KINDS:
+        publish_activity(st.session_state.users_data, username, kind, entry)
+
+# Class Overview Summary
+# Stored on the teacher's record and updated whenever an enrolled student logs something
+CLASS_RECENT_DAYS = 14
+
+def _napfa_summary(test):
+    """Latest test as kept in the summary, with what regrade_napfa_test needs"""
+    return {'total': test['total'], 'medal': test['medal'], 'grades': test['grades'], 'date': test['date'],
+            'age': test['age'], 'gender': test['gender'], 'scores': test['scores'],
+            'standards_version': napfa_test_version(test)}
+
+def summarize_student(student):
+    """Compact row for the class summary (one pass over the student's workouts)"""
+    cutoff = (datetime.now() - timedelta(days=CLASS_RECENT_DAYS)).strftime('%Y-%m-%d')
+    recent_workouts = {}
+    last_workout = None
+    for exercise in student.get('exercises', []):
+        if exercise['date'] >= cutoff:
+            recent_workouts[exercise['date']] = recent_workouts.get(exercise['date'], 0) + 1
+        if last_workout is None or exercise['date'] > last_workout:
+            last_workout = exercise['date']
+    
+    return {
+        'name': student.get('name', ''),
+        'age': student.get('age'),
+        'gender': student.get('gender'),
+        'total_workouts': len(student.get('exercises', [])),
+        'last_workout': last_workout,
+        'recent_workouts': recent_workouts,
+        'napfa': _napfa_summary(student['napfa_history'][-1]) if student.get('napfa_history') else None
+    }
+
+def refresh_class_summary(teacher_data, users_data, rebuild=False):
+    """Make sure the teacher's class summary covers exactly the enrolled students, returns True if it changed"""
+    if rebuild or 'class_summary' not in teacher_data:
+        teacher_data['class_summary'] = {'students': {}, 'updated': None}
+    rows = teacher_data['class_summary']['students']
+    enrolled = {username for username in teacher_data.get('students', []) if username in users_data}
+    
+    changed = False
+    for username in enrolled - rows.keys():
+        rows[username] = summarize_student(users_data[username])
+        changed = True
+    for username in rows.keys() - enrolled:
+        del rows[username]
+        changed = True
+    
+    if changed:
+        teacher_data['class_summary']['updated'] = datetime.now().strftime('%Y-%m-%d %H:%M')
+    return changed
+
+def update_class_summary(users_data, username, kind, entry):
+    """Apply one student log event to their teacher's class summary"""
+    student = users_data.get(username, {})
+    teacher = users_data.get(student.get('teacher_class') or '')
+    if not teacher or 'class_summary' not in teacher:
+        # Built the first time the teacher opens the dashboard
+        return
+    
+    rows = teacher['class_summary']['students']
+    row = rows.get(username)
+    if row is None:
+        rows[username] = summarize_student(student)
+    elif kind == 'exercise':
+        row['total_workouts'] += 1
+        if row['last_workout'] is None or entry['date'] > row['last_workout']:
+            row['last_workout'] = entry['date']
+        row['recent_workouts'][entry['date']] = row['recent_workouts'].get(entry['date'], 0) + 1
+        cutoff = (datetime.now() - timedelta(days=CLASS_RECENT_DAYS)).strftime('%Y-%m-%d')
+        row['recent_workouts'] = {d: c for d, c in row['recent_workouts'].items() if d >= cutoff}
+    elif kind == 'napfa':
+        row['napfa'] = _napfa_summary(entry)
+    else:
+        return
+    teacher['class_summary']['updated'] = datetime.now().strftime('%Y-%m-%d %H:%M')
+
+# Derived indexes over the loaded users data
+def users_file_version():
+    """Changes whenever the users file is rewritten, unlike the users dict which is reloaded every rerun"""
+    try:
+        stat = os.stat(DATA_FILE)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def get_users_index(name, builder):
+    """Return an index built from the loaded users data, rebuilt only when the users file or the standards change"""
+    cache = st.session_state.setdefault('users_indexes', {})
+    # Reloaded standards are newly compiled tables, and some indexes hold regraded grades
+    version = (users_file_version(), id(NAPFA_GRADE_TABLES))
+    entry = cache.get(name)
+    if entry is None or entry[0] != version:
+        entry = (version, builder(st.session_state.users_data))
+        cache[name] = entry
+    return entry[1]
+
+# List Pagination
+def _turn_page(key, step):
+    """Button callback, runs before the rerun so the controls render for the new page"""
+    st.session_state[key] = st.session_state.get(key, 1) + step
+
+def paginate(total, key, page_size=20, reset_on=None):
+    """Render page controls and return the (start, end) slice of the current page"""
+    # Start again from page 1 whenever the filter that produced the list changes
+    if st.session_state.get(f"{key}_filter") != reset_on:
+        st.session_state[f"{key}_filter"] = reset_on
+        st.session_state[key] = 1
+    
+    pages = max(1, -(-total // page_size))
+    page = min(st.session_state.get(key, 1), pages)
+    
+    if pages > 1:
+        col1, col2, col3 = st.columns([1, 3, 1])
+        with col1:
+            st.button("◀ Prev", key=f"{key}_prev", disabled=page <= 1, on_click=_turn_page, args=(key, -1))
+        with col3:
+            st.button("Next ▶", key=f"{key}_next", disabled=page >= pages, on_click=_turn_page, args=(key, 1))
+        with col2:
+            start = (page - 1) * page_size
+            st.caption(f"Page {page} of {pages} · showing {start + 1}-{min(start + page_size, total)} of {total}")
+    
+    st.session_state[key] = page
+    start = (page - 1) * page_size
+    return start, min(start + page_size, total)
+
+# Friend Graph
+def build_friend_graph(users_data):
+    """Build set adjacency and pending-request indexes (both directions) from the stored lists"""
+    graph = {'friends': {}, 'incoming': {}, 'outgoing': {}}
+    for username, data in users_data.items():
+        graph['friends'][username] = set(data.get('friends', []))
+        graph['incoming'][username] = set(data.get('friend_requests', []))
+        graph['outgoing'].setdefault(username, set())
+
+    for username, requesters in graph['incoming'].items():
+        for requester in requesters:
+            graph['outgoing'].setdefault(requester, set()).add(username)
+    return graph
+
+def get_friend_graph():
+    """Friend graph for the current users data"""
+    return get_users_index('friend_graph', build_friend_graph)
+
+def _sync_friend_lists(users_data, graph, username):
+    """Write one user's sets back to the stored lists"""
+    if username in users_data:
+        users_data[username]['friends'] = sorted(graph['friends'].setdefault(username, set()))
+        users_data[username]['friend_requests'] = sorted(graph['incoming'].setdefault(username, set()))
+
+def send_friend_request(users_data, sender, target):
+    """Record a pending request from sender to target, returns an error message or None"""
+    graph = get_friend_graph()
+
+    if target not in users_data:
+        return "User not found"
+    if target == sender:
+        return "You can't add yourself!"
+    if users_data[target].get('role') == 'teacher':
+        return "Teachers can't be added as friends"
+    if target in graph['friends'].get(sender, set()):
+        return "Already friends!"
+    if target in graph['outgoing'].get(sender, set()):
+        return "Request already sent!"
+    if target in graph['incoming'].get(sender, set()):
+        return f"{target} already sent you a request - accept it above!"
+
+    graph['incoming'].setdefault(target, set()).add(sender)
+    graph['outgoing'].setdefault(sender, set()).add(target)
+    _sync_friend_lists(users_data, graph, target)
+    invalidate_friend_suggestions(sender, target)
+    return None
+
+def _clear_pending(graph, a, b):
+    """Remove any pending request between two users, in either direction"""
+    graph['incoming'].setdefault(a, set()).discard(b)
+    graph['incoming'].setdefault(b, set()).discard(a)
+    graph['outgoing'].setdefault(a, set()).discard(b)
+    graph['outgoing'].setdefault(b, set()).discard(a)
+
+def accept_friend_request(users_data, username, requester):
+    """Make two users friends and clear their pending requests, updating both records together"""
+    graph = get_friend_graph()
+    _clear_pending(graph, username, requester)
+
+    if requester in users_data:
+        graph['friends'].setdefault(username, set()).add(requester)
+        graph['friends'].setdefault(requester, set()).add(username)
+
+    _sync_friend_lists(users_data, graph, username)
+    _sync_friend_lists(users_data, graph, requester)
+    invalidate_friend_suggestions(username, requester)
+
+def decline_friend_request(users_data, username, requester):
+    """Drop a pending request without creating a friendship"""
+    graph = get_friend_graph()
+    _clear_pending(graph, username, requester)
+    _sync_friend_lists(users_data, graph, username)
+    _sync_friend_lists(users_data, graph, requester)
+    invalidate_friend_suggestions(username, requester)
+
+def remove_friend(users_data, username, friend):
+    """Remove a friendship from both users, along with each other's feed events"""
+    graph = get_friend_graph()
+    graph['friends'].setdefault(username, set()).discard(friend)
+    graph['friends'].setdefault(friend, set()).discard(username)
+    _sync_friend_lists(users_data, graph, username)
+    _sync_friend_lists(users_data, graph, friend)
+    invalidate_friend_suggestions(username, friend)
+    purge_activity(users_data, username, friend)
+    purge_activity(users_data, friend, username)
+
+def mutual_friend_count(graph, a, b):
+    """Number of friends two users have in common"""
+    return len(graph['friends'].get(a, set()) & graph['friends'].get(b, set()))
+
+def friends_of_friends(graph, username):
+    """Mutual friend counts for everyone two hops away who isn't already a friend"""
+    my_friends = graph['friends'].get(username, set())
+    counts = {}
+    for friend in my_friends:
+        for candidate in graph['friends'].get(friend, set()):
+            if candidate != username and candidate not in my_friends:
+                counts[candidate] = counts.get(candidate, 0) + 1
+    return counts
+
+# Friend Suggestions
+SUGGESTION_CANDIDATE_LIMIT = 200  # candidates taken from each source
+SUGGESTION_COUNT = 5
+SUGGESTION_CACHE_SECONDS = 600
+
+def build_membership_index(users_data):
+    """Index students by school and by (school, class)"""
+    index = {'school': {}, 'class': {}}
+    for username, data in users_data.items():
+        if data.get('role') == 'teacher':
+            continue
+        school = data.get('school')
+        if school:
+            index['school'].setdefault(school, set()).add(username)
+            if data.get('class'):
+                index['class'].setdefault((school, data['class']), set()).add(username)
+    return index
+
+def get_membership_index():
+    """School/class membership index for the current users data"""
+    return get_users_index('membership', build_membership_index)
+
+def _take(usernames, excluded, limit):
+    """Up to `limit` usernames not in `excluded`, without walking the rest of the set"""
+    result = []
+    for username in usernames:
+        if len(result) >= limit:
+            break
+        if username not in excluded:
+            result.append(username)
+    return result
+
+def compute_friend_suggestions(users_data, username, count=SUGGESTION_COUNT):
+    """Rank people the user may know by mutual friends, class, school and NAPFA similarity"""
+    user = users_data[username]
+    graph = get_friend_graph()
+    membership = get_membership_index()
+    
+    excluded = ({username} | graph['friends'].get(username, set()) |
+                graph['incoming'].get(username, set()) | graph['outgoing'].get(username, set()))
+    
+    # Bounded candidate generation from each source
+    mutual_counts = friends_of_friends(graph, username)
+    candidates = set(sorted(mutual_counts, key=mutual_counts.get, reverse=True)[:SUGGESTION_CANDIDATE_LIMIT])
+    classmates = membership['class'].get((user.get('school'), user.get('class')), set())
+    candidates.update(_take(classmates, excluded, SUGGESTION_CANDIDATE_LIMIT))
+    schoolmates = membership['school'].get(user.get('school'), set())
+    candidates.update(_take(schoolmates, excluded | classmates, SUGGESTION_CANDIDATE_LIMIT))
+    candidates -= excluded
+    
+    my_napfa = user['napfa_history'][-1]['total'] if user.get('napfa_history') else None
+    
+    suggestions = []
+    for candidate in candidates:
+        data = users_data.get(candidate)
+        if not data or data.get('role') == 'teacher':
+            continue
+        
+        mutual = mutual_counts.get(candidate, 0)
+        same_class = candidate in classmates
+        same_school = candidate in schoolmates
+        score = 3 * mutual + 2 * same_class + 1 * same_school
+        
+        reasons = []
+        if mutual:
+            reasons.append(f"{mutual} mutual friend{'s' if mutual != 1 else ''}")
+        if same_class:
+            reasons.append("same class")
+        elif same_school:
+            reasons.append("same school")
+        
+        if my_napfa is not None and data.get('napfa_history'):
+            gap = abs(data['napfa_history'][-1]['total'] - my_napfa)
+            score += max(0, 1 - gap / 10)
+            if gap <= 2:
+                reasons.append("similar NAPFA score")
+        
+        suggestions.append({'username': candidate, 'name': data.get('name', candidate),
+                            'score': round(score, 2), 'reasons': reasons})
+    
+    suggestions.sort(key=lambda x: (-x['score'], x['username']))
+    return suggestions[:count]
+
+@st.cache_resource
+def _suggestion_cache():
+    """Process-wide so a graph change made in one session invalidates every session's copy"""
+    return {'entries': {}, 'lock': threading.Lock()}
+
+def get_friend_suggestions(username):
+    """Cached suggestions for a user, recomputed after graph changes or when stale"""
+    cache = _suggestion_cache()
+    with cache['lock']:
+        cached = cache['entries'].get(username)
+    if cached is None or time.time() - cached[0] > SUGGESTION_CACHE_SECONDS:
+        cached = (time.time(), compute_friend_suggestions(st.session_state.users_data, username))
+        with cache['lock']:
+            cache['entries'][username] = cached
+    return cached[1]
+
+def invalidate_friend_suggestions(*usernames):
+    """Drop cached suggestions for users whose friend graph changed"""
+    cache = _suggestion_cache()
+    with cache['lock']:
+        for username in usernames:
+            cache['entries'].pop(username, None)
+
+# Friend Activity Feed
+# Events kept per user; older ones drop off as new ones arrive
+ACTIVITY_FEED_SIZE = 50
+ACTIVITY_EVENT_KINDS = ('exercise', 'napfa', 'badge')
+
+def describe_activity(kind, entry):
+    """One-line summary of a log entry for friends' feeds"""
+    if kind == 'exercise':
+        return f"💪 logged {entry['name']} ({entry['duration']} min, {entry['intensity']})"
+    elif kind == 'napfa':
+        return f"🏃 completed a NAPFA test: {entry['total']}/30 ({entry['medal']})"
+    else:  # badge
+        return f"🎖️ earned {entry['name']}"
+
+def publish_activity(users_data, username, kind, entry):
+    """Fan an event out to each friend's bounded feed (skipped if the user doesn't share activity)"""
+    author = users_data.get(username, {})
+    if not author.get('share_activity', False):
+        return
+    
+    event = {
+        'user': username,
+        'name': author.get('name', username),
+        'text': describe_activity(kind, entry),
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M')
+    }
+    
+    for friend in get_friend_graph()['friends'].get(username, set()):
+        if friend in users_data:
+            feed = users_data[friend].setdefault('activity_feed', [])
+            feed.append(event)
+            del feed[:-ACTIVITY_FEED_SIZE]
+
+def purge_activity(users_data, reader, author):
+    """Remove an author's events from one reader's feed"""
+    if reader in users_data and users_data[reader].get('activity_feed'):
+        users_data[reader]['activity_feed'] = [e for e in users_data[reader]['activity_feed'] if e['user'] != author]
+
+# Head-to-head Friend Challenges
+FRIEND_CHALLENGE_TYPES = {
+    'workouts': 'Most workouts',
+    'napfa': 'Highest NAPFA score',
+    'streak': 'Longest workout streak'
+}
+
+# Finished challenges kept per user
+FRIEND_CHALLENGES_KEPT = 10
+
+def _new_challenge_progress():
+    return {'workouts': 0, 'workout_days': [], 'napfa_best': 0}
+
+def _add_to_challenge_progress(progress, kind, entry):
+    if kind == 'exercise':
+        progress['workouts'] += 1
+        if entry['date'] not in progress['workout_days']:
+            bisect.insort(progress['workout_days'], entry['date'])
+    elif kind == 'napfa':
+        progress['napfa_best'] = max(progress['napfa_best'], entry['total'])
+
+def _challenge_progress_from_logs(user_data, challenge):
+    """One player's progress from their logs dated inside the challenge"""
+    progress = _new_challenge_progress()
+    for kind, log in (('exercise', 'exercises'), ('napfa', 'napfa_history')):
+        for entry in user_data.get(log, []):
+            if challenge['start'] <= entry['date'] <= challenge['end']:
+                _add_to_challenge_progress(progress, kind, entry)
+    return progress
+
+def _challenge_copies(users_data, challenge):
+    """Every participant's stored copy of a challenge"""
+    return [c for player in (challenge['challenger'], challenge['opponent']) if player in users_data
+            for c in users_data[player].get('friend_challenges', []) if c['id'] == challenge['id']]
+
+def _ensure_challenge_progress(users_data, challenge):
+    """Challenges started before progress was kept get it rebuilt from the logs, on every copy"""
+    if 'progress' in challenge:
+        return
+    progress = {player: _challenge_progress_from_logs(users_data.get(player, {}), challenge)
+                for player in (challenge['challenger'], challenge['opponent'])}
+    for stored in _challenge_copies(users_data, challenge):
+        stored['progress'] = copy.deepcopy(progress)
+
+def create_friend_challenge(users_data, challenger, opponent, challenge_type, weeks=1):
+    """Start a challenge running to the end of the current ISO week (or later weeks), returns an error message or None"""
+    active = [c for c in users_data[challenger].get('friend_challenges', []) if c['status'] == 'active']
+    if any(opponent in (c['challenger'], c['opponent']) and c['type'] == challenge_type for c in active):
+        return "You already have this challenge running with them!"
+    
+    today = datetime.now()
+    week_end = today + timedelta(days=6 - today.weekday() + 7 * (weeks - 1))
+    challenge = {
+        'id': f"{challenger}-{opponent}-{today.strftime('%Y%m%d%H%M%S')}",
+        'type': challenge_type,
+        'challenger': challenger,
+        'opponent': opponent,
+        'start': today.strftime('%Y-%m-%d'),
+        'end': week_end.strftime('%Y-%m-%d'),
+        'status': 'active'
+    }
+    # Anything already logged today counts
+    challenge['progress'] = {player: _challenge_progress_from_logs(users_data[player], challenge)
+                             for player in (challenger, opponent)}
+    
+    for username in (challenger, opponent):
+        users_data[username].setdefault('friend_challenges', []).append(copy.deepcopy(challenge))
+    return None
+
+def record_challenge_event(users_data, username, kind, entry):
+    """Count a new log entry into both copies of every active challenge whose dates it falls in"""
+    for challenge in users_data[username].get('friend_challenges', []):
+        if challenge['status'] != 'active' or not challenge['start'] <= entry['date'] <= challenge['end']:
+            continue
+        if 'progress' not in challenge:
+            # The rebuild reads the logs, which already hold this entry
+            _ensure_challenge_progress(users_data, challenge)
+            continue
+        for stored in _challenge_copies(users_data, challenge):
+            _add_to_challenge_progress(stored['progress'].setdefault(username, _new_challenge_progress()), kind, entry)
+
+def friend_challenge_score(challenge, player):
+    """A player's score from the progress kept on the challenge"""
+    progress = challenge.get('progress', {}).get(player, _new_challenge_progress())
+    if challenge['type'] == 'workouts':
+        return progress['workouts']
+    if challenge['type'] == 'napfa':
+        return progress['napfa_best']
+    
+    # Longest run of workout days inside the challenge, with the leaderboard's 2-day gap rule
+    longest, current, previous = 0, 0, None
+    for day in progress['workout_days']:
+        if previous and (datetime.strptime(day, '%Y-%m-%d') - datetime.strptime(previous, '%Y-%m-%d')).days <= 2:
+            current += 1
+        else:
+            current = 1
+        longest, previous = max(longest, current), day
+    return longest
+
+def settle_friend_challenges(users_data, username):
+    """Freeze the scores of ended challenges on both players' copies at once, and trim old finished ones"""
+    challenges = users_data[username].get('friend_challenges', [])
+    today = datetime.now().strftime('%Y-%m-%d')
+    changed = False
+    
+    for challenge in challenges:
+        if challenge['status'] == 'active' and challenge['end'] < today:
+            _ensure_challenge_progress(users_data, challenge)
+            final_scores = {player: friend_challenge_score(challenge, player)
+                            for player in (challenge['challenger'], challenge['opponent'])}
+            for stored in _challenge_copies(users_data, challenge):
+                stored['final_scores'] = dict(final_scores)
+                stored['status'] = 'finished'
+            changed = True
+    
+    finished = [c for c in challenges if c['status'] == 'finished']
+    if len(finished) > FRIEND_CHALLENGES_KEPT:
+        dropped = {c['id'] for c in finished[:-FRIEND_CHALLENGES_KEPT]}
+        users_data[username]['friend_challenges'] = [c for c in challenges if c['id'] not in dropped]
+        changed = True
+    return changed
+
 # Community and Social Features
 def community_features():
     st.header("🏆 Community & Achievements")
@@ -1424,6 +2918,7 @@ def community_features():
             for badge in new_badges:
                 user_data['badges'].append(badge)
                 user_data['total_points'] = user_data.get('total_points', 0) + badge['points']
+                apply_log_event(st.session_state.username, user_data, 'badge', badge)
             
             update_user_data(user_data)
         
@@ -1455,8 +2950,10 @@ def community_features():
         st.write("### 🎖️ Earned Badges")
         
         if user_data.get('badges'):
-            # Sort by date
-            badges = sorted(user_data['badges'], key=lambda x: x['date'], reverse=True)
+            # Badges are appended as they are earned, so newest first is the list reversed
+            total = len(user_data['badges'])
+            start, end = paginate(total, "badges_page", page_size=9)
+            badges = user_data['badges'][total - end:total - start][::-1]
             
             cols = st.columns(3)
             for idx, badge in enumerate(badges):
@@ -1499,58 +2996,74 @@ def community_features():
     with tab3:
         st.subheader("👥 Friends")
         
+        graph = get_friend_graph()
+        
         # Friend requests
-        friend_requests = user_data.get('friend_requests', [])
+        friend_requests = sorted(graph['incoming'].get(st.session_state.username, set()))
         if friend_requests:
             st.write("### 📬 Friend Requests")
             for requester in friend_requests:
                 col1, col2, col3 = st.columns([3, 1, 1])
                 with col1:
                     requester_data = all_users.get(requester, {})
-                    st.write(f"**{requester_data.get('name', 'Unknown')}** (@{requester})")
+                    mutual = mutual_friend_count(graph, st.session_state.username, requester)
+                    st.write(f"**{requester_data.get('name', 'Unknown')}** (@{requester})" + 
+                             (f" - {mutual} mutual friend{'s' if mutual != 1 else ''}" if mutual else ""))
                 with col2:
                     if st.button("✅ Accept", key=f"accept_{requester}"):
-                        user_data['friends'].append(requester)
-                        user_data['friend_requests'].remove(requester)
-                        
-                        # Add to requester's friends too
-                        all_users[requester]['friends'].append(st.session_state.username)
-                        
+                        accept_friend_request(all_users, st.session_state.username, requester)
                         update_user_data(user_data)
-                        save_users(all_users)
                         st.success(f"Added {requester} as friend!")
                         st.rerun()
                 with col3:
                     if st.button("❌ Decline", key=f"decline_{requester}"):
-                        user_data['friend_requests'].remove(requester)
+                        decline_friend_request(all_users, st.session_state.username, requester)
                         update_user_data(user_data)
                         st.rerun()
         
+        # Activity feed (pushed into this user's record when friends log things)
+        activity_feed = user_data.get('activity_feed', [])
+        if activity_feed:
+            st.write("### 📰 Friend Activity")
+            for event in reversed(activity_feed[-10:]):
+                st.write(f"**{event['name']}** {event['text']} · {event['date']}")
+        
         # Add friend
         st.write("### ➕ Add Friend")
         new_friend = st.text_input("Enter username", key="add_friend_input")
         if st.button("Send Friend Request"):
-            if new_friend in all_users:
-                if new_friend == st.session_state.username:
-                    st.error("You can't add yourself!")
-                elif new_friend in user_data.get('friends', []):
-                    st.error("Already friends!")
-                elif new_friend in all_users[new_friend].get('friend_requests', []):
-                    st.error("Request already sent!")
-                else:
-                    # Add request to target user
-                    all_users[new_friend]['friend_requests'].append(st.session_state.username)
-                    save_users(all_users)
-                    st.success(f"Friend request sent to {new_friend}!")
+            error = send_friend_request(all_users, st.session_state.username, new_friend)
+            if error:
+                st.error(error)
             else:
-                st.error("User not found")
+                save_users(all_users)
+                st.success(f"Friend request sent to {new_friend}!")
+        
+        # Suggestions
+        suggestions = get_friend_suggestions(st.session_state.username)
+        if suggestions:
+            st.write("### 💡 People You May Know")
+            for suggestion in suggestions:
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.write(f"**{suggestion['name']}** (@{suggestion['username']}) - {', '.join(suggestion['reasons']) or 'FitTrack member'}")
+                with col2:
+                    if st.button("➕ Add", key=f"suggest_{suggestion['username']}"):
+                        error = send_friend_request(all_users, st.session_state.username, suggestion['username'])
+                        if error:
+                            st.error(error)
+                        else:
+                            save_users(all_users)
+                            st.success(f"Friend request sent to {suggestion['username']}!")
+                            st.rerun()
         
         # Friends list
         st.write("### 👥 My Friends")
-        friends = user_data.get('friends', [])
+        friends = sorted(graph['friends'].get(st.session_state.username, set()))
         
         if friends:
-            for friend in friends:
+            start, end = paginate(len(friends), "friends_page", page_size=10)
+            for friend in friends[start:end]:
                 friend_data = all_users.get(friend, {})
                 
                 with st.expander(f"👤 {friend_data.get('name', 'Unknown')} (@{friend})"):
@@ -1560,6 +3073,7 @@ def community_features():
                         st.write(f"**Age:** {friend_data.get('age', 'N/A')}")
                         st.write(f"**School:** {friend_data.get('school', 'N/A')}")
                         st.write(f"**Level:** {friend_data.get('level', 'Novice')}")
+                        st.write(f"**Mutual Friends:** {mutual_friend_count(graph, st.session_state.username, friend)}")
                     
                     with col2:
                         if friend_data.get('napfa_history'):
@@ -1576,10 +3090,8 @@ def community_features():
                         st.info(f"🎖️ Recently earned: {recent_badge['name']}")
                     
                     if st.button(f"Remove Friend", key=f"remove_{friend}"):
-                        user_data['friends'].remove(friend)
-                        all_users[friend]['friends'].remove(st.session_state.username)
+                        remove_friend(all_users, st.session_state.username, friend)
                         update_user_data(user_data)
-                        save_users(all_users)
                         st.rerun()
         else:
             st.info("No friends yet. Add friends to see their progress!")
@@ -1590,66 +3102,26 @@ def community_features():
         # Weekly Challenges
         st.write("### 🏃 Weekly Challenges")
         
-        # Define weekly challenges
-        weekly_challenges = [
-            {
-                'name': 'Workout Warrior',
-                'description': 'Complete 5 workouts this week',
-                'target': 5,
-                'type': 'workouts',
-                'points': 50
-            },
-            {
-                'name': 'Cardio King',
-                'description': 'Total 150 minutes of exercise this week',
-                'target': 150,
-                'type': 'minutes',
-                'points': 60
-            },
-            {
-                'name': 'Early Bird',
-                'description': 'Log 7 days of sleep tracking',
-                'target': 7,
-                'type': 'sleep',
-                'points': 40
-            }
-        ]
+        # Progress comes from this week's maintained counters
+        period = challenge_period_key()
+        counters = get_period_counters(user_data, period)
         
-        # Check progress
-        week_ago = datetime.now() - timedelta(days=7)
+        st.caption(f"Week {period} - challenges reset every Monday")
         
-        for challenge in weekly_challenges:
-            with st.expander(f"{'✅' if challenge['name'] in [c['name'] for c in user_data.get('completed_challenges', [])] else '⚡'} {challenge['name']} (+{challenge['points']} pts)", expanded=True):
+        for challenge in get_weekly_challenges(user_data, all_users):
+            completed = challenge['name'] in counters['completed']
+            with st.expander(f"{'✅' if completed else '⚡'} {challenge['name']} (+{challenge['points']} pts)", expanded=True):
                 st.write(f"**Goal:** {challenge['description']}")
                 
-                # Calculate progress
-                if challenge['type'] == 'workouts':
-                    weekly_workouts = [e for e in user_data.get('exercises', []) 
-                                     if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                    progress = len(weekly_workouts)
-                elif challenge['type'] == 'minutes':
-                    weekly_workouts = [e for e in user_data.get('exercises', []) 
-                                     if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                    progress = sum(e['duration'] for e in weekly_workouts)
-                else:  # sleep
-                    weekly_sleep = [s for s in user_data.get('sleep_history', []) 
-                                  if datetime.strptime(s['date'], '%Y-%m-%d') >= week_ago]
-                    progress = len(weekly_sleep)
+                progress = counters.get(challenge['type'], 0)
                 
                 st.progress(min(progress / challenge['target'], 1.0))
                 st.write(f"**Progress:** {progress}/{challenge['target']}")
                 
-                if progress >= challenge['target']:
-                    completed_names = [c['name'] for c in user_data.get('completed_challenges', [])]
-                    if challenge['name'] not in completed_names:
-                        st.success("🎉 Challenge completed! Points awarded!")
-                        user_data.setdefault('completed_challenges', []).append({
-                            'name': challenge['name'],
-                            'completed_date': datetime.now().strftime('%Y-%m-%d'),
-                            'points': challenge['points']
-                        })
-                        user_data['total_points'] = user_data.get('total_points', 0) + challenge['points']
-                        update_user_data(user_data)
+                if progress >= challenge['target'] and not completed:
+                    st.success("🎉 Challenge completed! Points awarded!")
+                    complete_challenge(user_data, challenge, period)
+                    update_user_data(user_data)
         
         # Friend Challenges
         st.write("")
@@ -1661,16 +3133,46 @@ def community_features():
         else:
             selected_friend = st.selectbox("Challenge a friend", friends)
             
-            challenge_types = [
-                "Most workouts this week",
-                "Highest NAPFA score",
-                "Longest workout streak"
-            ]
-            
-            challenge_type = st.selectbox("Challenge type", challenge_types)
+            challenge_type = st.selectbox("Challenge type", list(FRIEND_CHALLENGE_TYPES.keys()),
+                                          format_func=lambda t: FRIEND_CHALLENGE_TYPES[t])
+            challenge_weeks = st.selectbox("Duration", [1, 2, 4], format_func=lambda w: "This week" if w == 1 else f"{w} weeks")
             
             if st.button("Send Challenge"):
-                st.success(f"Challenge sent to {selected_friend}! (Feature coming soon)")
+                error = create_friend_challenge(all_users, st.session_state.username, selected_friend, challenge_type, challenge_weeks)
+                if error:
+                    st.error(error)
+                else:
+                    update_user_data(user_data)
+                    st.success(f"Challenge sent to {selected_friend}!")
+                    st.rerun()
+        
+        if settle_friend_challenges(all_users, st.session_state.username):
+            update_user_data(user_data)
+        
+        my_challenges = user_data.get('friend_challenges', [])
+        for challenge in reversed(my_challenges):
+            rival = challenge['opponent'] if challenge['challenger'] == st.session_state.username else challenge['challenger']
+            rival_data = all_users.get(rival, {})
+            
+            if challenge['status'] == 'active':
+                _ensure_challenge_progress(all_users, challenge)
+                my_score = friend_challenge_score(challenge, st.session_state.username)
+                rival_score = friend_challenge_score(challenge, rival)
+            else:
+                my_score = challenge['final_scores'].get(st.session_state.username, 0)
+                rival_score = challenge['final_scores'].get(rival, 0)
+            
+            if my_score > rival_score:
+                standing = "🏆 You won!" if challenge['status'] == 'finished' else "📈 You're leading"
+            elif my_score < rival_score:
+                standing = f"😤 {rival_data.get('name', rival)} won" if challenge['status'] == 'finished' else "📉 You're behind"
+            else:
+                standing = "🤝 Tied"
+            
+            icon = "⚔️" if challenge['status'] == 'active' else "🏁"
+            st.write(f"{icon} **{FRIEND_CHALLENGE_TYPES[challenge['type']]}** vs {rival_data.get('name', rival)} "
+                     f"(@{rival}) - **{my_score}** : {rival_score} | {standing} | "
+                     f"{challenge['start']} to {challenge['end']}")
         
         # Class Challenges
         st.write("")
@@ -1722,6 +3224,21 @@ def community_features():
         
         st.info("ℹ️ When enabled, your stats will be visible on leaderboards. Your friends can always see your profile.")
         
+        st.write("### 📰 Activity Sharing")
+        
+        current_sharing = user_data.get('share_activity', False)
+        new_sharing = st.checkbox("Share my workouts, NAPFA results and badges in my friends' activity feeds", value=current_sharing)
+        
+        if new_sharing != current_sharing:
+            user_data['share_activity'] = new_sharing
+            if not new_sharing:
+                # Take back anything already shared
+                for friend in get_friend_graph()['friends'].get(st.session_state.username, set()):
+                    purge_activity(all_users, friend, st.session_state.username)
+            update_user_data(user_data)
+            st.success("✅ Settings updated!")
+            st.rerun()
+        
         # Update school/class
         st.write("")
         st.write("### 🏫 School & Class")
@@ -1739,9 +3256,281 @@ def community_features():
             user_data['school'] = new_school
             user_data['class'] = new_class
             update_user_data(user_data)
+            invalidate_friend_suggestions(st.session_state.username)
             st.success("✅ Updated!")
             st.rerun()
 
+# Insight Cache
+# Computed insights are memoized per user and keyed by a history fingerprint, so repeat visits
+# skip the work; apply_log_event bumps the version and drops the user's entries on every write
+INSIGHT_CACHE_SIZE = 512
+
+@st.cache_resource
+def _insight_cache():
+    """Process-wide LRU shared by every session"""
+    return {'entries': OrderedDict(), 'lock': threading.Lock()}
+
+def history_fingerprint(user_data):
+    """Cheap key that changes whenever a history is written"""
+    return (user_data.get('history_version', 0), len(user_data.get('exercises', [])),
+            len(user_data.get('sleep_history', [])), len(user_data.get('napfa_history', [])))
+
+def memo_insight(username, user_data, name, compute):
+    """compute(user_data), reused while the user's histories and today's date are unchanged"""
+    key = (username, name, history_fingerprint(user_data), datetime.now().strftime('%Y-%m-%d'))
+    cache = _insight_cache()
+    with cache['lock']:
+        if key in cache['entries']:
+            cache['entries'].move_to_end(key)
+            return cache['entries'][key]
+    
+    result = compute(user_data)
+    with cache['lock']:
+        cache['entries'][key] = result
+        while len(cache['entries']) > INSIGHT_CACHE_SIZE:
+            cache['entries'].popitem(last=False)
+    return result
+
+def invalidate_insights(username):
+    cache = _insight_cache()
+    with cache['lock']:
+        for key in [key for key in cache['entries'] if key[0] == username]:
+            del cache['entries'][key]
+
+# ML Prediction Insights
+# Pure functions of a user's histories, computed through memo_insight
+def napfa_projection_insight(user_data):
+    """Least-squares NAPFA trend, gold timing and a six-month projection"""
+    history = user_data['napfa_history']
+    fit = fit_napfa_trends([history])
+    _, gold_total, gold_grade, _ = NAPFA_MEDALS[0]
+    
+    months = list(range(7))
+    projections = [predict_napfa_trends(fit, 30 * month) for month in months]
+    projection = pd.DataFrame({
+        'Date': [(datetime.now() + timedelta(days=30 * month)).strftime('%b %Y') for month in months],
+        'Predicted Score': [p[0][0, 0] for p in projections],
+        'Lower (95%)': [p[1][0, 0] for p in projections],
+        'Upper (95%)': [p[2][0, 0] for p in projections]
+    }).set_index('Date')
+    
+    return {
+        'has_trend': bool(fit['has_trend'][0]),
+        'fitted_now': float(fit['intercept'][0, 0]),
+        'monthly_change': float(fit['slope'][0, 0] * 30),
+        'gold_total': gold_total,
+        'gold_grade': gold_grade,
+        'days_to_gold': float(days_to_medal(fit, gold_total, gold_grade)[0]),
+        # Gold also needs a minimum grade in every component, so a flat component blocks it
+        'stalled': [c for c, slope, now in zip(NAPFA_COMPONENTS, fit['slope'][0, 1:], fit['intercept'][0, 1:])
+                    if now < gold_grade and slope <= 0],
+        'has_interval': bool(fit['dof'][0] > 0),
+        'projection': projection
+    }
+
+def medal_gap_insight(user_data):
+    return medal_gap_plans(user_data['napfa_history'][-1], user_data['napfa_history'])
+
+def average_sleep_hours(sleep_history):
+    return sum(s['hours'] + s['minutes'] / 60 for s in sleep_history) / len(sleep_history)
+
+def sleep_impact_insight(user_data, model):
+    """Average sleep and what the school's sleep model says it is worth in NAPFA points"""
+    avg_sleep_hours = average_sleep_hours(user_data['sleep_history'])
+    if avg_sleep_hours >= SLEEP_TARGET_HOURS:
+        rating, color = "Optimal", "#4caf50"
+    elif avg_sleep_hours >= 7:
+        rating, color = "Good", "#8bc34a"
+    else:
+        rating, color = "Below Optimal", "#ff9800"
+    
+    latest = user_data['napfa_history'][-1]
+    cohort, fit = sleep_cohort_estimate(model, latest['age'], latest['gender'])
+    result = {'avg_sleep_hours': avg_sleep_hours, 'rating': rating, 'color': color, 'cohort': cohort,
+              'fit': fit, 'predicted_improvement': None, 'interval': None}
+    if fit is None:
+        result['insight'] = "There isn't enough sleep and NAPFA data at school yet to estimate what sleep is worth."
+        return result
+    
+    extra_hours = max(SLEEP_TARGET_HOURS - avg_sleep_hours, 0)
+    gain = fit['slope'] * extra_hours
+    result['predicted_improvement'] = gain
+    if fit['slope_se'] is not None:
+        result['interval'] = (gain - 1.96 * fit['slope_se'] * extra_hours, gain + 1.96 * fit['slope_se'] * extra_hours)
+    
+    clear = fit['slope_se'] is not None and fit['slope'] - 1.96 * fit['slope_se'] > 0
+    if not clear:
+        result['insight'] = (f"Among {describe_sleep_cohort(cohort)} there is no clear link between sleep and NAPFA "
+                             f"totals yet ({fit['n']} tests, r = {fit['r']:.2f}).")
+    elif extra_hours == 0:
+        result['insight'] = (f"Your sleep supports peak performance! Among {describe_sleep_cohort(cohort)}, each extra hour "
+                             f"of sleep goes with {fit['slope']:+.1f} NAPFA points.")
+    else:
+        result['insight'] = (f"Among {describe_sleep_cohort(cohort)}, each extra hour of sleep goes with {fit['slope']:+.1f} "
+                             f"NAPFA points. Getting {SLEEP_TARGET_HOURS} hours could be worth about {gain:+.1f} points.")
+    return result
+
+def injury_risk_insight(user_data):
+    """Risk level from the acute:chronic workload ratio, with sleep as a recovery factor"""
+    exercises = user_data['exercises']
+    two_weeks_ago = (datetime.now() - timedelta(days=14)).strftime('%Y-%m-%d')
+    workouts_per_week = sum(1 for e in exercises if e['date'] >= two_weeks_ago) / 2
+    
+    state = get_training_load(user_data)
+    acute, chronic = training_load_today(state)
+    ratio = acwr(acute, chronic)
+    baseline_days = (datetime.now() - datetime.strptime(state['first'], '%Y-%m-%d')).days if state['first'] else 0
+    
+    risk_score = 0
+    risk_factors = []
+    if ratio is None:
+        zone = None
+    else:
+        zone, _ = acwr_zone(ratio)
+        if zone == "Danger zone":
+            risk_score += 50
+            risk_factors.append(f"⚠️ Training load spike: this week's load is {ratio:.2f}x your 4-week average")
+        elif zone == "Caution":
+            risk_score += 25
+            risk_factors.append(f"⚠️ Load is climbing fast ({ratio:.2f}x your 4-week average)")
+        elif zone == "Under-training":
+            risk_score += 10
+            risk_factors.append(f"⚠️ Load has dropped to {ratio:.2f}x your usual, so ramp back up gradually")
+    if baseline_days < CHRONIC_LOAD_DAYS:
+        risk_factors.append(f"ℹ️ Still building a 4-week baseline ({baseline_days} days so far), so the ratio is rough")
+    
+    # Sleep factor
+    if len(user_data.get('sleep_history', [])) >= 7 and average_sleep_hours(user_data['sleep_history']) < 7:
+        risk_score += 20
+        risk_factors.append("⚠️ Poor sleep reduces recovery")
+    
+    if risk_score >= 50:
+        level, color, recommendation = "High Risk", "#f44336", "🚨 REDUCE intensity and take more rest days!"
+    elif risk_score >= 25:
+        level, color, recommendation = "Moderate Risk", "#ff9800", "⚠️ Increase your training load more gradually."
+    else:
+        level, color, recommendation = "Low Risk", "#4caf50", "✅ Your training load is well-balanced!"
+    return {'risk_score': risk_score, 'factors': risk_factors, 'level': level, 'color': color,
+            'recommendation': recommendation, 'workouts_per_week': workouts_per_week,
+            'acute': acute, 'chronic': chronic, 'acwr': ratio, 'zone': zone,
+            'history': acwr_history(state)}
+
+# Goal Probability Engine
+# Monte Carlo odds of reaching a goal by its deadline: each simulated path bootstraps the user's own
+# past rates of change between measurements, stepping at their usual measuring interval.
+# All paths are simulated together as one array and results are memoized with the other insights
+GOAL_SIMULATIONS = 5000
+GOAL_MIN_MEASUREMENTS = 3
+# Far deadlines take longer steps rather than more of them, so the cost doesn't grow with the horizon
+GOAL_MAX_STEPS = 100
+
+GOAL_METRICS = {
+    'weight': "weight (kg)",
+    'total': "NAPFA total",
+    'SU': "sit-ups",
+    'SBJ': "standing broad jump (cm)",
+    'SAR': "sit and reach (cm)",
+    'PU': "pull-ups",
+    'SR': "shuttle run (s)",
+    'RUN': "2.4km run time (min)",
+    'progress': "progress (%)"
+}
+
+# Basic goal types and the series their target value refers to
+GOAL_TYPE_METRICS = {
+    'Weight Loss': 'weight',
+    'Muscle Gain': 'weight',
+    'NAPFA Improvement': 'total',
+    'Flexibility': 'SAR'
+}
+
+GOAL_NUMBER_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+GOAL_RELATIVE_WORDS = {'lose', 'gain', 'increase', 'decrease', 'reduce', 'drop', 'improve', 'by', 'more', 'less'}
+
+def goal_target(goal):
+    """(metric, target value) for a goal, or None when its target can't be measured"""
+    if 'metric' in goal:
+        return goal['metric'], goal['target_value']
+    if 'time_bound' in goal:
+        # SMART goals made before targets were stored are tracked by their progress check-ins
+        return 'progress', 100
+    metric = GOAL_TYPE_METRICS.get(goal.get('type'))
+    text = goal.get('target', '').lower()
+    numbers = GOAL_NUMBER_PATTERN.findall(text)
+    # Only a single absolute value is a target; "Lose 3kg" or "60kg by June 2025" are left alone
+    if metric is None or len(numbers) != 1 or 'grade' in text or set(re.findall(r'[a-z]+', text)) & GOAL_RELATIVE_WORDS:
+        return None
+    return metric, float(numbers[0])
+
+def goal_series(user_data, metric, goal=None):
+    """Dates and values of a metric, one measurement per day (the last one logged that day)"""
+    if metric == 'weight':
+        points = [(b['date'], b['weight']) for b in user_data.get('bmi_history', []) if 'weight' in b]
+    elif metric == 'total':
+        points = [(t['date'], t['total']) for t in user_data.get('napfa_history', [])]
+    elif metric == 'progress':
+        points = [(goal['created_date'], 0)] + [(c['date'], c['progress']) for c in goal.get('weekly_checkpoints', [])]
+    else:
+        points = [(t['date'], t['scores'][metric]) for t in user_data.get('napfa_history', [])
+                  if metric in t.get('scores', {})]
+    by_day = dict(sorted(points, key=lambda p: p[0]))
+    return np.array(list(by_day.keys()), dtype='datetime64[D]'), np.array(list(by_day.values()), dtype=float)
+
+def simulate_goal(dates, values, target, deadline, simulations=GOAL_SIMULATIONS):
+    """Chance of reaching `target` by `deadline`, moving away from where the series started"""
+    if len(values) < GOAL_MIN_MEASUREMENTS:
+        return None
+    current = values[-1]
+    gaps = np.diff(dates).astype(float)
+    rates = np.diff(values) / gaps
+    increasing = target >= values[0]
+    horizon = (np.datetime64(deadline, 'D') - dates[-1]).astype(float)
+    reached = current >= target if increasing else current <= target
+    if reached or horizon <= 0:
+        return {'probability': float(reached), 'current': current, 'final': np.array([current] * 3), 'measurements': len(values)}
+    
+    steps = min(int(np.ceil(horizon / max(np.median(gaps), 1))), GOAL_MAX_STEPS)
+    # Fixed seed so the odds don't jitter between visits
+    rng = np.random.default_rng(0)
+    paths = current + np.cumsum(rng.choice(rates, size=(simulations, steps)) * (horizon / steps), axis=1)
+    hit = (paths.max(axis=1) >= target) if increasing else (paths.min(axis=1) <= target)
+    return {
+        'probability': float(hit.mean()),
+        'current': current,
+        'final': np.percentile(paths[:, -1], [10, 50, 90]),
+        'measurements': len(values)
+    }
+
+def goal_probability(user_data, goal, metric, target, deadline):
+    dates, values = goal_series(user_data, metric, goal)
+    return simulate_goal(dates, values, target, deadline)
+
+def show_goal_probability(user_data, goal, deadline):
+    """Chance of reaching a goal by its deadline, or what's needed to estimate it"""
+    measured = goal_target(goal)
+    if measured is None:
+        st.caption("🎲 Give this goal a numeric target to see your chances of reaching it")
+        return
+    metric, target = measured
+    key = f"goal|{metric}|{target}|{deadline}|{goal.get('created_date', goal.get('created'))}|{len(goal.get('weekly_checkpoints', []))}"
+    result = memo_insight(st.session_state.username, user_data, key,
+                          lambda data: goal_probability(data, goal, metric, target, deadline))
+    if result is None:
+        st.caption(f"🎲 Log your {GOAL_METRICS[metric]} at least {GOAL_MIN_MEASUREMENTS} times to see your chances of reaching this goal")
+        return
+    
+    probability = result['probability']
+    message = f"🎲 **{probability:.0%} chance** of reaching {target:g} ({GOAL_METRICS[metric]}) by {deadline}"
+    if probability >= 0.7:
+        st.success(message)
+    elif probability >= 0.3:
+        st.info(message)
+    else:
+        st.warning(message)
+    low, median, high = result['final']
+    st.caption(f"{GOAL_SIMULATIONS:,} simulations replaying your {result['measurements'] - 1} past changes. "
+               f"Likely value at the deadline: {median:.1f} (80% range {low:.1f}-{high:.1f}), now {result['current']:g}")
+
 # AI Insights and Recommendations
 def ai_insights():
     st.header("🤖 AI Fitness Coach")
@@ -1790,60 +3579,62 @@ def ai_insights():
                 st.info(f"**Points Needed for Gold:** {points_needed}")
                 st.write("Complete another NAPFA test to get improvement rate predictions!")
         else:
-            # ML Prediction: Linear regression on NAPFA scores
+            # Least-squares trend through every test, with a 95% prediction interval
             napfa_history = user_data['napfa_history']
-            scores = [test['total'] for test in napfa_history]
-            dates = [datetime.strptime(test['date'], '%Y-%m-%d') for test in napfa_history]
-            
-            # Calculate improvement rate
-            days_between = [(dates[i] - dates[i-1]).days for i in range(1, len(dates))]
-            score_changes = [scores[i] - scores[i-1] for i in range(1, len(scores))]
+            projection = memo_insight(st.session_state.username, user_data, 'napfa_projection', napfa_projection_insight)
             
-            if sum(days_between) > 0:
-                avg_improvement_per_day = sum(score_changes) / sum(days_between)
-                avg_improvement_per_month = avg_improvement_per_day * 30
-                
-                current_score = scores[-1]
+            if not projection['has_trend']:
+                st.info("Your tests are all on the same day. Take another test later to see a trend!")
+            else:
+                current_score = napfa_history[-1]['total']
+                days_to_gold = projection['days_to_gold']
                 
                 col1, col2 = st.columns(2)
                 with col1:
                     st.metric("Current NAPFA", f"{current_score}/30")
-                    st.metric("Improvement Rate", f"+{avg_improvement_per_month:.2f} pts/month")
+                    st.metric("Trend", f"{projection['monthly_change']:+.2f} pts/month")
                 
                 with col2:
-                    if current_score >= 21:
+                    if '🥇' in napfa_history[-1]['medal']:
                         st.success("🥇 Gold Medal Achieved!")
+                    elif np.isfinite(days_to_gold):
+                        predicted_date = datetime.now() + timedelta(days=days_to_gold)
+                        st.metric("Points to Gold", max(projection['gold_total'] - current_score, 0))
+                        st.metric("Predicted Gold Date", predicted_date.strftime('%B %Y'))
+                        
+                        st.info(f"📅 At your current rate, you'll meet every Gold requirement in ~{days_to_gold / 30:.1f} months!")
+                    elif projection['monthly_change'] <= 0:
+                        st.warning("Your score is decreasing. Focus on training to improve!")
                     else:
-                        points_needed = 21 - current_score
-                        if avg_improvement_per_day > 0:
-                            days_to_gold = points_needed / avg_improvement_per_day
-                            months_to_gold = days_to_gold / 30
-                            predicted_date = datetime.now() + timedelta(days=days_to_gold)
-                            
-                            st.metric("Points to Gold", points_needed)
-                            st.metric("Predicted Gold Date", predicted_date.strftime('%B %Y'))
-                            
-                            st.info(f"📅 At your current rate, you'll reach Gold in ~{months_to_gold:.1f} months!")
-                        else:
-                            st.warning("Your score is decreasing. Focus on training to improve!")
+                        st.warning(f"Your total is rising, but {', '.join(projection['stalled'])} must also reach "
+                                   f"grade {projection['gold_grade']} for Gold.")
                 
                 # Show prediction chart
                 st.write("### 📈 Score Projection")
                 
-                # Project next 6 months
-                future_dates = [datetime.now() + timedelta(days=30*i) for i in range(7)]
-                future_scores = [current_score + (avg_improvement_per_day * 30 * i) for i in range(7)]
-                future_scores = [min(max(s, 0), 30) for s in future_scores]  # Cap at 0-30
-                
-                df = pd.DataFrame({
-                    'Date': [d.strftime('%b %Y') for d in future_dates],
-                    'Predicted Score': future_scores
-                })
+                df = projection['projection']
+                st.line_chart(df.dropna(axis=1, how='all'))
                 
-                st.line_chart(df.set_index('Date'))
-                
-                st.write(f"**Model:** Linear regression based on {len(napfa_history)} test(s)")
-                st.write(f"**Confidence:** {'High' if len(napfa_history) >= 4 else 'Medium' if len(napfa_history) >= 3 else 'Low'}")
+                st.write(f"**Model:** Least-squares line through {len(napfa_history)} test(s) (fitted now: {projection['fitted_now']:.1f}/30)")
+                if projection['has_interval']:
+                    half_width = (df['Upper (95%)'].iloc[-1] - df['Lower (95%)'].iloc[-1]) / 2
+                    st.write(f"**Uncertainty:** ±{half_width:.1f} points by {df.index[-1]} (95% prediction interval)")
+                else:
+                    st.write("**Uncertainty:** Take a third test to get a prediction interval")
+        
+        # Medal rules also need a minimum grade in every component, so plan per component
+        if has_napfa:
+            latest_napfa = user_data['napfa_history'][-1]
+            if has_napfa_standards(latest_napfa['age'], latest_napfa['gender'], napfa_test_version(latest_napfa)):
+                st.write("### 🧭 Cheapest Path to a Better Medal")
+                plans = memo_insight(st.session_state.username, user_data, 'medal_gap', medal_gap_insight)
+                if not plans:
+                    st.success("🏆 You already have the top medal!")
+                for medal, changes in plans:
+                    with st.expander(f"{medal}: improve {len(changes)} component(s)", expanded=medal == plans[-1][0]):
+                        for change in changes:
+                            st.write(f"• {describe_gap_change(change)}")
+                st.caption("Targets favour components you have improved in past tests and the smallest score changes.")
         
         st.write("---")
         
@@ -1853,44 +3644,34 @@ def ai_insights():
         if not has_sleep or not has_napfa:
             st.info("Track sleep for 7+ days and complete NAPFA to see correlation!")
         else:
-            sleep_data = user_data['sleep_history']
-            
-            # Calculate average sleep
-            avg_sleep_hours = sum([s['hours'] + s['minutes']/60 for s in sleep_data]) / len(sleep_data)
-            
-            # Analyze NAPFA performance vs sleep
+            sleep_model = refresh_sleep_model(st.session_state.users_data)
+            sleep_impact = memo_insight(st.session_state.username, user_data, f"sleep_impact|{sleep_model['computed']}",
+                                        lambda data: sleep_impact_insight(data, sleep_model))
             napfa_score = user_data['napfa_history'][-1]['total']
             
-            # Statistical correlation (simplified)
-            if avg_sleep_hours >= 8:
-                performance_rating = "Optimal"
-                color = "#4caf50"
-                insight = "Your sleep supports peak performance! Keep it up."
-                predicted_improvement = 5
-            elif avg_sleep_hours >= 7:
-                performance_rating = "Good"
-                color = "#8bc34a"
-                insight = "Good sleep, but getting 8+ hours could improve your NAPFA score by ~2-3 points."
-                predicted_improvement = 2.5
-            else:
-                performance_rating = "Below Optimal"
-                color = "#ff9800"
-                insight = "⚠️ Poor sleep is limiting your performance. Getting 8+ hours could improve your score by ~5 points!"
-                predicted_improvement = 5
-            
             col1, col2 = st.columns(2)
             with col1:
-                st.metric("Average Sleep", f"{avg_sleep_hours:.1f} hours")
+                st.metric("Average Sleep", f"{sleep_impact['avg_sleep_hours']:.1f} hours")
                 st.metric("Current NAPFA", f"{napfa_score}/30")
             
             with col2:
-                st.markdown(f'<div class="stat-card" style="background: {color}; color: white;"><h3>{performance_rating}</h3></div>', unsafe_allow_html=True)
-                st.metric("Potential Gain", f"+{predicted_improvement:.1f} points")
-            
-            st.info(f"💡 **Insight:** {insight}")
-            
-            # Show correlation
-            st.write("**Research shows:** Students who sleep 8+ hours score on average 15% higher on NAPFA tests.")
+                st.markdown(f'<div class="stat-card" style="background: {sleep_impact["color"]}; color: white;"><h3>{sleep_impact["rating"]}</h3></div>', unsafe_allow_html=True)
+                if sleep_impact['predicted_improvement'] is not None:
+                    st.metric("Potential Gain", f"{sleep_impact['predicted_improvement']:+.1f} points")
+                    if sleep_impact['interval']:
+                        low, high = sleep_impact['interval']
+                        st.caption(f"95% range {low:+.1f} to {high:+.1f}")
+            
+            st.info(f"💡 **Insight:** {sleep_impact['insight']}")
+            
+            # Show how each sleep band scores in the student's cohort
+            if sleep_impact['fit']:
+                bands = sleep_impact['fit']['bands']
+                st.write(f"**At school ({describe_sleep_cohort(sleep_impact['cohort'])}):** " + " · ".join(
+                    f"{label}: {bands[label]['mean_total']:.1f}/30 avg ({bands[label]['n']} tests)"
+                    for label, _, _ in SLEEP_BANDS if label in bands))
+                st.caption(f"Average sleep in the {SLEEP_MODEL_WINDOW_DAYS} days before each NAPFA test, "
+                           f"refreshed daily · last run {sleep_model['computed']}")
         
         st.write("---")
         
@@ -1900,64 +3681,25 @@ def ai_insights():
         if not has_exercises:
             st.info("Log 5+ workouts to get injury risk analysis!")
         else:
-            exercises = user_data['exercises']
+            risk = memo_insight(st.session_state.username, user_data, 'injury_risk', injury_risk_insight)
             
-            # Calculate workout intensity distribution
-            intensity_counts = {'Low': 0, 'Medium': 0, 'High': 0}
-            for ex in exercises:
-                intensity_counts[ex['intensity']] += 1
+            st.markdown(f'<div class="stat-card" style="background: {risk["color"]}; color: white;"><h2>Risk Level: {risk["level"]}</h2><p>{risk["recommendation"]}</p></div>', unsafe_allow_html=True)
             
-            total = sum(intensity_counts.values())
-            high_intensity_ratio = intensity_counts['High'] / total if total > 0 else 0
-            
-            # Check workout frequency (last 2 weeks)
-            two_weeks_ago = datetime.now() - timedelta(days=14)
-            recent_workouts = [e for e in exercises 
-                             if datetime.strptime(e['date'], '%Y-%m-%d') >= two_weeks_ago]
-            
-            workouts_per_week = len(recent_workouts) / 2
-            
-            # Risk calculation
-            risk_score = 0
-            risk_factors = []
-            
-            if high_intensity_ratio > 0.7:
-                risk_score += 30
-                risk_factors.append("⚠️ Too many high-intensity workouts (>70%)")
-            
-            if workouts_per_week > 6:
-                risk_score += 25
-                risk_factors.append("⚠️ Insufficient rest days (<1 per week)")
-            
-            if workouts_per_week < 2:
-                risk_score += 15
-                risk_factors.append("⚠️ Inconsistent training increases injury risk")
-            
-            # Sleep factor
-            if has_sleep:
-                if avg_sleep_hours < 7:
-                    risk_score += 20
-                    risk_factors.append("⚠️ Poor sleep reduces recovery")
-            
-            # Determine risk level
-            if risk_score >= 50:
-                risk_level = "High Risk"
-                risk_color = "#f44336"
-                recommendation = "🚨 REDUCE intensity and take more rest days!"
-            elif risk_score >= 25:
-                risk_level = "Moderate Risk"
-                risk_color = "#ff9800"
-                recommendation = "⚠️ Balance your training intensity and rest."
-            else:
-                risk_level = "Low Risk"
-                risk_color = "#4caf50"
-                recommendation = "✅ Your training is well-balanced!"
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Acute Load (7d)", f"{risk['acute']:.0f}")
+            with col2:
+                st.metric("Chronic Load (28d)", f"{risk['chronic']:.0f}")
+            with col3:
+                st.metric("ACWR", f"{risk['acwr']:.2f}" if risk['acwr'] is not None else "-", risk['zone'], delta_color="off")
             
-            st.markdown(f'<div class="stat-card" style="background: {risk_color}; color: white;"><h2>Risk Level: {risk_level}</h2><p>{recommendation}</p></div>', unsafe_allow_html=True)
+            if risk['history']['ACWR'].notna().any():
+                st.line_chart(risk['history'][['ACWR']])
+                st.caption("Load = minutes × intensity weight. Aim for an ACWR of 0.8-1.3; above 1.5 is a spike.")
             
-            if risk_factors:
+            if risk['factors']:
                 st.write("**Risk Factors:**")
-                for factor in risk_factors:
+                for factor in risk['factors']:
                     st.write(factor)
             
             st.write("")
@@ -1970,7 +3712,57 @@ def ai_insights():
         
         st.write("---")
         
-        # Prediction 4: Optimal Workout Timing
+        # Prediction 4: Readiness and taper from the fitness-fatigue model
+        st.write("### 🔋 Readiness & Taper Planner")
+        
+        if not has_exercises:
+            st.info("Log 5+ workouts to see your readiness and taper plan!")
+        else:
+            model = memo_insight(st.session_state.username, user_data, 'fitness_fatigue',
+                                 lambda data: fit_banister([(data['exercises'], data.get('napfa_history', []))]))
+            fitted = bool(model['fitted'][0])
+            form = banister_form(model)[0]
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Fitness", f"{model['fitness'][0]:.0f}")
+            with col2:
+                st.metric("Fatigue", f"{model['fatigue'][0]:.0f}")
+            with col3:
+                if fitted:
+                    st.metric("Readiness", f"{np.clip(model['p0'][0] + form, 0, 30):.1f}/30", f"{form:+.1f} from training")
+                else:
+                    st.metric("Form", f"{form:+.0f}", "Fresh" if form >= 0 else "Fatigued", delta_color="off")
+            
+            if fitted:
+                st.caption(f"Personal model from {model['tests'][0]} NAPFA tests: fitness fades over ~{model['tau_fitness'][0]} days, "
+                           f"fatigue over ~{model['tau_fatigue'][0]} days (fit error ±{model['rmse'][0]:.1f} points)")
+            else:
+                st.caption(f"Using standard time constants ({BANISTER_DEFAULT[0]} and {BANISTER_DEFAULT[1]} days). "
+                           f"Log {BANISTER_MIN_TESTS}+ NAPFA tests for a model fitted to you.")
+            
+            test_date = st.date_input("Next NAPFA test", value=datetime.now().date() + timedelta(days=21),
+                                      min_value=datetime.now().date() + timedelta(days=1), key="taper_test_date")
+            taper = plan_taper(model, 0, (test_date - datetime.now().date()).days)
+            unit = "points" if fitted else "form"
+            
+            if taper['days'] == 0:
+                st.success("✅ Keep your current training load right up to the test")
+            else:
+                st.success(f"✅ Cut your training load by {taper['cut']:.0%} for the last {taper['days']} days before the test")
+            if fitted:
+                st.write(f"Predicted NAPFA total: **{taper['predicted']:.1f}** (vs {taper['no_taper']:.1f} without a taper)")
+            else:
+                st.write(f"Predicted form on test day: **{taper['predicted']:+.0f}** (vs {taper['no_taper']:+.0f} without a taper)")
+            
+            with st.expander("Compare taper plans"):
+                st.line_chart(taper['plans'].pivot_table(index='Taper (days)', columns='Load Cut', values='Predicted'))
+                st.caption(f"Predicted {unit} on test day, assuming your average daily load of the last 4 weeks "
+                           f"({model['recent_load'][0]:.0f}) until the taper starts")
+        
+        st.write("---")
+        
+        # Prediction 5: Optimal Workout Timing
         st.write("### ⏰ Optimal Training Time Analysis")
         
         if not has_exercises or not has_napfa:
@@ -2032,11 +3824,11 @@ def ai_insights():
             stats.append(f"**Your Percentile:** Top {100-percentile}% for your age")
         
         if has_sleep:
-            stats.append(f"**Average Sleep:** {avg_sleep_hours:.1f} hours")
+            stats.append(f"**Average Sleep:** {average_sleep_hours(user_data['sleep_history']):.1f} hours")
         
         if has_exercises:
-            stats.append(f"**Total Workouts:** {len(exercises)}")
-            stats.append(f"**Recent Activity:** {workouts_per_week:.1f} workouts/week")
+            stats.append(f"**Total Workouts:** {len(user_data['exercises'])}")
+            stats.append(f"**Recent Activity:** {risk['workouts_per_week']:.1f} workouts/week")
         
         for stat in stats:
             st.write(stat)
@@ -2080,7 +3872,7 @@ def ai_insights():
                                             ["Sit-Ups", "Standing Broad Jump", "Sit and Reach", 
                                              "Pull-Ups", "Shuttle Run", "2.4km Run"])
                     target_grade = 5
-                elif "increase total" in specific_goal:
+                elif "increase total" in specific_goal.lower():
                     target_increase = st.number_input("Points to increase", min_value=1, max_value=10, value=3)
                 
             elif goal_category == "Weight Management":
@@ -2198,6 +3990,31 @@ def ai_insights():
                 for milestone in milestones:
                     st.write(milestone)
             
+            # Numeric target the goal probability engine can track, where the goal has one
+            goal_metric = None
+            latest_napfa = user_data['napfa_history'][-1] if user_data.get('napfa_history') else None
+            if goal_category == "NAPFA Improvement" and latest_napfa:
+                if "Gold" in specific_goal:
+                    goal_metric = ('total', NAPFA_MEDALS[0][1])
+                elif "increase total" in specific_goal.lower():
+                    goal_metric = ('total', latest_napfa['total'] + target_increase)
+                elif "specific component" in specific_goal and has_napfa_standards(
+                        latest_napfa['age'], latest_napfa['gender'], napfa_test_version(latest_napfa)):
+                    code = {'Sit-Ups': 'SU', 'Standing Broad Jump': 'SBJ', 'Sit and Reach': 'SAR',
+                            'Pull-Ups': 'PU', 'Shuttle Run': 'SR', '2.4km Run': 'RUN'}[component]
+                    goal_metric = (code, napfa_score_needed(latest_napfa['age'], latest_napfa['gender'], code,
+                                                            target_grade, napfa_test_version(latest_napfa)))
+            elif goal_category == "Weight Management":
+                goal_metric = ('weight', target_weight)
+            elif goal_category == "Strength Building" and exercise in ("Pull-ups", "Sit-ups"):
+                goal_metric = ('PU' if exercise == "Pull-ups" else 'SU', target_reps)
+            elif goal_category == "Endurance Training" and distance == "2.4km":
+                target_minutes = _parse_run_times(pd.Series([target_time])).item()
+                if np.isfinite(target_minutes):
+                    goal_metric = ('RUN', round(target_minutes, 2))
+            elif goal_category == "Flexibility":
+                goal_metric = ('SAR', target_reach)
+            
             # Save goal
             if st.button("💾 Save SMART Goal", type="primary"):
                 smart_goal = {
@@ -2212,6 +4029,8 @@ def ai_insights():
                     'progress': 0,
                     'weekly_checkpoints': []
                 }
+                metric, target_value = goal_metric or ('progress', 100)
+                smart_goal['metric'], smart_goal['target_value'] = metric, float(target_value)
                 
                 if 'smart_goals' not in user_data:
                     user_data['smart_goals'] = []
@@ -2270,6 +4089,8 @@ def ai_insights():
                             st.success("Progress updated!")
                             st.rerun()
                         
+                        show_goal_probability(user_data, goal, goal['time_bound'])
+                        
                         # Show milestones
                         if goal.get('milestones'):
                             st.write("")
@@ -2398,7 +4219,7 @@ def ai_insights():
                     st.subheader("Your Weekly Workout Schedule")
                     
                     # Determine workout frequency based on NAPFA scores
-                    weak_areas = [test for test, grade in latest_napfa['grades'].items() if grade < 3]
+                    weak_areas = [test for test, grade in regrade_napfa_test(latest_napfa).items() if grade < 3]
                     workout_days = 5 if len(weak_areas) >= 3 else 4
                     
                     # Generate weekly schedule
@@ -2892,7 +4713,7 @@ def ai_insights():
             st.info("📝 Complete a NAPFA test first to get personalized workout recommendations!")
         else:
             latest_napfa = user_data['napfa_history'][-1]
-            grades = latest_napfa['grades']
+            grades = regrade_napfa_test(latest_napfa)
             
             st.write(f"**Based on your latest NAPFA test ({latest_napfa['date']}):**")
             st.write(f"**Total Score:** {latest_napfa['total']} | **Medal:** {latest_napfa['medal']}")
@@ -2967,7 +4788,7 @@ def ai_insights():
             st.info("📝 Complete a NAPFA test first to get improvement advice!")
         else:
             latest_napfa = user_data['napfa_history'][-1]
-            grades = latest_napfa['grades']
+            grades = regrade_napfa_test(latest_napfa)
             
             # Find weakest areas
             weak_areas = [(test, grade) for test, grade in grades.items() if grade < 3]
@@ -2987,6 +4808,9 @@ def ai_insights():
                 
                 for test, grade in sorted(weak_areas, key=lambda x: x[1]):
                     with st.expander(f"📍 {test_names[test]} (Grade {grade})"):
+                        if has_napfa_standards(latest_napfa['age'], latest_napfa['gender'], napfa_test_version(latest_napfa)):
+                            st.info(f"🎯 **Your score:** {format_napfa_score(test, latest_napfa['scores'][test])} · "
+                                    f"**Next target:** {describe_next_grade(latest_napfa['age'], latest_napfa['gender'], test, grade, napfa_test_version(latest_napfa))}")
                         if test == 'SU':
                             st.write("**Why it matters:** Core strength is fundamental for all movements and injury prevention.")
                             st.write("**Quick win:** Do 3 sets of planks daily, increasing hold time weekly.")
@@ -3180,9 +5004,9 @@ def ai_insights():
             for idx, goal in enumerate(user_data['goals']):
                 with st.expander(f"🎯 {goal['type']} - {goal['target']}", expanded=True):
                     progress = goal['progress']
-                    target_date = datetime.strptime(goal['date'], '%Y-%m-%d')
-                    created_date = datetime.strptime(goal['created'], '%Y-%m-%d')
-                    today = datetime.now()
+                    target_date = datetime.strptime(goal['date'], '%Y-%m-%d').date()
+                    created_date = datetime.strptime(goal['created'], '%Y-%m-%d').date()
+                    today = datetime.now().date()
                     
                     # Calculate days
                     days_total = (target_date - created_date).days
@@ -3193,6 +5017,7 @@ def ai_insights():
                     st.progress(progress / 100)
                     st.write(f"**Current Progress:** {progress}%")
                     st.write(f"**Days Remaining:** {days_remaining} days")
+                    show_goal_probability(user_data, goal, goal['date'])
                     
                     # AI Prediction
                     if days_passed > 0:
@@ -3324,8 +5149,8 @@ def reminders_and_progress():
     # Check goals progress
     if user_data.get('goals'):
         for goal in user_data['goals']:
-            target_date = datetime.strptime(goal['date'], '%Y-%m-%d')
-            days_until = (target_date - datetime.now()).days
+            target_date = datetime.strptime(goal['date'], '%Y-%m-%d').date()
+            days_until = (target_date - datetime.now().date()).days
             if 0 <= days_until <= 7:
                 reminders.append(f"🎯 Goal deadline approaching: '{goal['target']}' in {days_until} days!")
     
@@ -3452,7 +5277,7 @@ def reminders_and_progress():
                     'Score': latest['scores'][test],
                     'Grade': grade
                 }
-                for test, grade in latest['grades'].items()
+                for test, grade in regrade_napfa_test(latest).items()
             ])
             
             st.dataframe(grades_df, use_container_width=True, hide_index=True)
@@ -4508,6 +6333,7 @@ def workout_timer():
                 'intensity': 'High',
                 'notes': f'HIIT session'
             })
+            apply_log_event(st.session_state.username, user_data, 'exercise', user_data['exercises'][0])
             update_user_data(user_data)
             st.balloons()
     
@@ -4717,6 +6543,7 @@ def workout_timer():
                         'intensity': 'Medium',
                         'notes': f'{len(st.session_state.workout_routine)} exercises'
                     })
+                    apply_log_event(st.session_state.username, user_data, 'exercise', user_data['exercises'][0])
                     update_user_data(user_data)
             
             with col2:
@@ -4850,6 +6677,937 @@ def workout_timer():
             st.write("3. Motivational phrase based on your style")
             st.write(f"4. Completion sound: {completion_sound}")
 
+# Class Grade Matrix
+# Latest NAPFA grades as a students x components int8 array, built from the class summary
+GRADE_COLORS = ['#ef9a9a', '#ffcc80', '#fff59d', '#e6ee9c', '#a5d6a7', '#66bb6a']
+
+def build_grade_matrix(summary_rows):
+    """Usernames, names, genders and an (n, 6) grade array with -1 for students not yet tested"""
+    usernames = list(summary_rows.keys())
+    grades = np.full((len(usernames), len(NAPFA_COMPONENTS)), -1, dtype=np.int8)
+    for i, username in enumerate(usernames):
+        napfa = summary_rows[username]['napfa']
+        if napfa:
+            test_grades = regrade_napfa_test(napfa)
+            grades[i] = [test_grades.get(component, -1) for component in NAPFA_COMPONENTS]
+    return {
+        'usernames': np.array(usernames, dtype=object),
+        'names': np.array([summary_rows[u]['name'] for u in usernames], dtype=object),
+        'genders': np.array([summary_rows[u]['gender'] for u in usernames], dtype=object),
+        'grades': grades
+    }
+
+def grade_distribution(grades):
+    """Students at each grade (rows 0-5) for each component (columns)"""
+    return (grades[:, :, None] == np.arange(6)).sum(axis=0).T
+
+def _grade_cell_style(grade):
+    return f"background-color: {GRADE_COLORS[int(grade)]}; color: black" if 0 <= grade <= 5 else ""
+
+# Participation Trend
+PARTICIPATION_WINDOWS = {
+    "4 weeks": 4,
+    "10 weeks": 10,
+    "12 weeks": 12,
+    "52 weeks": 52
+}
+
+def build_participation_matrix(students_data, n_weeks):
+    """Students x weeks activity matrix (last column = the most recent 7 days), built in one pass"""
+    usernames = list(students_data)
+    student_index = []
+    dates = []
+    for idx, username in enumerate(usernames):
+        for exercise in students_data[username].get('exercises', []):
+            student_index.append(idx)
+            dates.append(exercise['date'])
+    
+    matrix = np.zeros((len(usernames), n_weeks), dtype=bool)
+    if dates:
+        today = np.datetime64(datetime.now().strftime('%Y-%m-%d'), 'D')
+        days_ago = (today - np.array(dates, dtype='datetime64[D]')).astype(np.int64)
+        weeks_ago = days_ago // 7
+        in_window = (weeks_ago >= 0) & (weeks_ago < n_weeks)
+        matrix[np.array(student_index)[in_window], n_weeks - 1 - weeks_ago[in_window]] = True
+    return usernames, matrix
+
+def participation_trend(students_data, n_weeks):
+    """Active students per week as a DataFrame indexed by week start date"""
+    _, matrix = build_participation_matrix(students_data, n_weeks)
+    today = np.datetime64(datetime.now().strftime('%Y-%m-%d'), 'D')
+    week_starts = today - 7 * np.arange(n_weeks, 0, -1) + 1
+    return pd.DataFrame({
+        'Week Starting': pd.to_datetime(week_starts),
+        'Active Students': matrix.sum(axis=0)
+    }).set_index('Week Starting')
+
+# Class Report Export
+REPORT_FORMATS = {
+    "CSV": ('csv', 'text/csv'),
+    "Parquet": ('parquet', 'application/octet-stream'),
+    "Excel (XLSX)": ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+}
+
+# Rows buffered per Parquet row group
+REPORT_BATCH_SIZE = 500
+
+NAPFA_REPORT_COLUMNS = [
+    ('Sit-Ups', 'SU'), ('Broad Jump', 'SBJ'), ('Sit & Reach', 'SAR'),
+    ('Pull-Ups', 'PU'), ('Shuttle Run', 'SR'), ('2.4km Run', 'RUN')
+]
+
+def report_columns(include_napfa, include_workouts, include_attendance, include_history):
+    """Ordered (column, type) pairs for a report with these options"""
+    columns = [('Username', 'str'), ('Name', 'str'), ('Email', 'str'), ('Age', 'int'),
+               ('Gender', 'str'), ('Class', 'str')]
+    if include_history:
+        columns += [('Record', 'str'), ('Date', 'str'), ('Detail', 'str'), ('Value', 'float')]
+    if include_napfa:
+        columns += [('NAPFA Total', 'int'), ('Medal', 'str')] + [(name, 'int') for name, _ in NAPFA_REPORT_COLUMNS]
+    if include_workouts:
+        columns += [('Total Workouts', 'int'), ('Workouts This Week', 'int')]
+    if include_attendance:
+        columns += [('Login Streak', 'int'), ('Level', 'str'), ('Total Points', 'int')]
+    return columns
+
+def iter_school_students(all_users, school):
+    """All students of a school, one at a time"""
+    for username, data in all_users.items():
+        if data.get('role') != 'teacher' and data.get('school') == school:
+            yield username, data
+
+def iter_report_rows(students, include_napfa, include_workouts, include_attendance, include_history):
+    """Yield report rows one student (and optionally one history entry) at a time"""
+    week_start = (datetime.now() - timedelta(days=6)).strftime('%Y-%m-%d')
+    
+    for username, student in students:
+        identity = {
+            'Username': username,
+            'Name': student['name'],
+            'Email': student.get('email', ''),
+            'Age': student.get('age'),
+            'Gender': 'Male' if student.get('gender') == 'm' else 'Female',
+            'Class': student.get('class', '')
+        }
+        
+        row = dict(identity)
+        if include_history:
+            row['Record'] = 'Summary'
+        
+        if include_napfa and student.get('napfa_history'):
+            latest = student['napfa_history'][-1]
+            row['NAPFA Total'] = latest['total']
+            row['Medal'] = latest['medal']
+            latest_grades = regrade_napfa_test(latest)
+            for name, code in NAPFA_REPORT_COLUMNS:
+                row[name] = latest_grades.get(code, 0)
+        
+        if include_workouts:
+            row['Total Workouts'] = len(student.get('exercises', []))
+            row['Workouts This Week'] = sum(1 for e in student.get('exercises', []) if e['date'] >= week_start)
+        
+        if include_attendance:
+            row['Login Streak'] = student.get('login_streak', 0)
+            row['Level'] = student.get('level', 'Novice')
+            row['Total Points'] = student.get('total_points', 0)
+        
+        yield row
+        
+        if include_history:
+            for exercise in student.get('exercises', []):
+                yield dict(identity, Record='Exercise', Date=exercise['date'],
+                           Detail=f"{exercise['name']} ({exercise['intensity']})", Value=exercise['duration'])
+            for test in student.get('napfa_history', []):
+                yield dict(identity, Record='NAPFA', Date=test['date'], Detail=test['medal'], Value=test['total'])
+            for sleep in student.get('sleep_history', []):
+                yield dict(identity, Record='Sleep', Date=sleep['date'], Detail=sleep['quality'],
+                           Value=round(sleep['hours'] + sleep['minutes'] / 60, 2))
+            for bmi in student.get('bmi_history', []):
+                yield dict(identity, Record='BMI', Date=bmi['date'], Detail=bmi['category'], Value=bmi['bmi'])
+
+def write_report(rows, columns, file_format, out):
+    """Stream rows into a binary file object as CSV, Parquet or XLSX, returns the number of rows written"""
+    names = [name for name, _ in columns]
+    count = 0
+    
+    if file_format == 'csv':
+        text_out = io.TextIOWrapper(out, encoding='utf-8', newline='')
+        writer = csv.DictWriter(text_out, fieldnames=names, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        text_out.flush()
+        text_out.detach()
+    
+    elif file_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        arrow_types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64()}
+        schema = pa.schema([(name, arrow_types[kind]) for name, kind in columns])
+        with pq.ParquetWriter(out, schema) as writer:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                count += 1
+                if len(batch) >= REPORT_BATCH_SIZE:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    batch = []
+            if batch or count == 0:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    
+    else:  # xlsx
+        from openpyxl import Workbook
+        
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Report")
+        sheet.append(names)
+        for row in rows:
+            sheet.append([row.get(name) for name in names])
+            count += 1
+        workbook.save(out)
+    
+    return count
+
+# Bulk NAPFA Upload
+NAPFA_UPLOAD_COLUMNS = ['username', 'date', 'age', 'gender'] + [code for _, code in NAPFA_REPORT_COLUMNS]
+
+def napfa_upload_template():
+    """CSV template with one example row"""
+    return "username,date,age,gender,SU,SBJ,SAR,PU,SR,RUN\nstudent1,{},14,m,30,200,35,8,10.5,10:30\n".format(
+        datetime.now().strftime('%Y-%m-%d'))
+
+def read_napfa_upload(uploaded_file):
+    """Read an uploaded CSV or XLSX into a DataFrame of strings with lower-cased identity columns"""
+    if uploaded_file.name.lower().endswith('.xlsx'):
+        df = pd.read_excel(uploaded_file, dtype=str)
+    else:
+        df = pd.read_csv(uploaded_file, dtype=str)
+    df.columns = [str(c).strip() for c in df.columns]
+    df = df.rename(columns={c: c.lower() for c in df.columns if c.lower() in ('username', 'date', 'age', 'gender')})
+    df = df.rename(columns={c: c.upper() for c in df.columns if c.upper() in NAPFA_COMPONENTS})
+    return df.dropna(how='all').reset_index(drop=True)
+
+def _parse_run_times(values):
+    """2.4km run times as minutes; accepts m:ss or decimal minutes, NaN when unparseable"""
+    text = values.fillna('').astype(str).str.strip()
+    parts = text.str.split(':', n=1, expand=True).reindex(columns=[0, 1])
+    minutes = pd.to_numeric(parts[0], errors='coerce')
+    seconds = pd.to_numeric(parts[1], errors='coerce')
+    has_seconds = parts[1].notna()
+    valid_seconds = (seconds >= 0) & (seconds < 60)
+    return np.where(has_seconds, np.where(valid_seconds, minutes + seconds / 60, np.nan), minutes)
+
+def grade_napfa_upload(df, users_data, allowed_usernames):
+    """Grade every row in one pass; returns (graded DataFrame, {row number: [errors]})"""
+    n = len(df)
+    errors = {}
+    
+    def flag(mask, message):
+        for i in np.flatnonzero(mask):
+            errors.setdefault(int(i) + 2, []).append(message)  # +2: header row and 1-based rows
+    
+    missing = [c for c in ['username'] + NAPFA_COMPONENTS if c not in df.columns]
+    if missing:
+        return None, {1: [f"Missing columns: {', '.join(missing)}"]}
+    
+    usernames = df['username'].fillna('').astype(str).str.strip()
+    known = usernames.isin(allowed_usernames).to_numpy()
+    flag(~known, "Student is not in your class")
+    flag(usernames.duplicated(keep=False).to_numpy() & known, "Student appears more than once")
+    
+    # Age and gender default to the student's profile
+    profiles = [users_data.get(u, {}) for u in usernames]
+    ages = pd.to_numeric(df['age'], errors='coerce') if 'age' in df.columns else pd.Series(np.nan, index=df.index)
+    ages = ages.fillna(pd.Series([p.get('age') for p in profiles], dtype=float)).to_numpy()
+    genders = df['gender'].fillna('').astype(str).str.strip().str.lower().str[:1] if 'gender' in df.columns else pd.Series('', index=df.index)
+    genders = np.where(genders == '', [p.get('gender', '') for p in profiles], genders).astype(object)
+    flag(known & ~np.isin(ages, NAPFA_AGES), f"Age must be between {NAPFA_AGES[0]}-{NAPFA_AGES[-1]}")
+    flag(known & ~np.isin(genders, ['m', 'f']), "Gender must be m or f")
+    
+    dates = df['date'] if 'date' in df.columns else pd.Series(np.nan, index=df.index)
+    parsed_dates = pd.to_datetime(dates, errors='coerce', format='mixed')
+    flag(dates.notna().to_numpy() & parsed_dates.isna().to_numpy(), "Date is not a valid date")
+    today = datetime.now().strftime('%Y-%m-%d')
+    dates = parsed_dates.dt.strftime('%Y-%m-%d').fillna(today).to_numpy(dtype=object)
+    flag(dates > today, "Date is in the future")
+    # History is kept in date order and the last test is treated as the latest
+    latest_tests = np.array([p['napfa_history'][-1]['date'] if p.get('napfa_history') else '' for p in profiles], dtype=object)
+    flag(known & (dates < latest_tests), "Date is before the student's latest NAPFA test")
+    flag(known & (dates == latest_tests), "Student already has a NAPFA test on this date")
+    
+    scores = {code: pd.to_numeric(df[code], errors='coerce').to_numpy(dtype=float) for code in NAPFA_COMPONENTS if code != 'RUN'}
+    scores['RUN'] = _parse_run_times(df['RUN'])
+    for code in NAPFA_COMPONENTS:
+        flag(np.isnan(scores[code]) | (scores[code] < 0), f"{code} score is missing or invalid")
+    
+    # Grade each age/gender group against its standards with searchsorted
+    grades = np.zeros((n, len(NAPFA_COMPONENTS)), dtype=np.int8)
+    for age in NAPFA_AGES:
+        for gender in ('m', 'f'):
+            group = (ages == age) & (genders == gender)
+            if not group.any() or not has_napfa_standards(age, gender):
+                continue
+            for column, code in enumerate(NAPFA_COMPONENTS):
+                grades[group, column] = napfa_grades(age, gender, code, scores[code][group])
+    
+    totals = grades.sum(axis=1)
+    medal_names = np.array([m[0] for m in NAPFA_MEDALS] + ["No Medal"], dtype=object)
+    medals = medal_names[napfa_medal_index(totals, grades.min(axis=1))]
+    
+    graded = pd.DataFrame({'Row': np.arange(n) + 2, 'username': usernames, 'name': [p.get('name', '') for p in profiles],
+                           'date': dates, 'age': ages, 'gender': genders})
+    for column, code in enumerate(NAPFA_COMPONENTS):
+        graded[code] = scores[code]
+        graded[f"{code} grade"] = grades[:, column]
+    graded['total'] = totals
+    graded['medal'] = medals
+    graded['valid'] = ~graded['Row'].isin(list(errors.keys()))
+    return graded, errors
+
+def save_napfa_upload(graded, users_data):
+    """Append every valid graded row to its student's NAPFA history, returns the number saved"""
+    saved = 0
+    # Norms are swapped in memory row by row and written once at the end
+    norms = get_norms(users_data)
+    for row in graded[graded['valid']].to_dict('records'):
+        student = users_data[row['username']]
+        entry = {
+            'date': row['date'],
+            'age': int(row['age']),
+            'gender': row['gender'],
+            'scores': {code: (round(float(row[code]), 2) if code in ('SR', 'RUN') else int(row[code])) for code in NAPFA_COMPONENTS},
+            'grades': {code: int(row[f"{code} grade"]) for code in NAPFA_COMPONENTS},
+            'total': int(row['total']),
+            'medal': row['medal'],
+            'standards_version': NAPFA_STANDARDS_VERSION,
+            'school': student.get('school')
+        }
+        student.setdefault('napfa_history', []).append(entry)
+        apply_log_event(row['username'], student, 'napfa', entry, norms)
+        saved += 1
+    if saved:
+        save_norms(norms)
+    return saved
+
+# School-wide Analytics (Head of Department)
+
+# Emails the school has approved as Heads of Department; the first HOD must come from here,
+# after which HODs approve requests from teachers at their own school
+HOD_EMAILS_FILE = 'fittrack_hod_emails.json'
+
+def load_hod_emails():
+    if os.path.exists(HOD_EMAILS_FILE):
+        with open(HOD_EMAILS_FILE, 'r') as f:
+            return {email.lower() for email in json.load(f)}
+    return set()
+
+def is_head_of_department(user_data):
+    """HOD access is granted by the school's list or by another HOD, never self-assigned"""
+    if user_data.get('role') != 'teacher':
+        return False
+    return bool(user_data.get('hod_granted_by')) or user_data.get('email', '').lower() in load_hod_emails()
+
+def hod_requests(users_data, school):
+    """Teachers at a school waiting for HOD access; accounts that ticked the old self-declared box count as requests"""
+    return [(username, data) for username, data in users_data.items()
+            if data.get('role') == 'teacher' and data.get('school') == school
+            and (data.get('hod_requested') or data.get('is_hod')) and not is_head_of_department(data)]
+
+def school_stats(students):
+    """Aggregate NAPFA, weakness and participation counts over student records in one pass"""
+    week_start = (datetime.now() - timedelta(days=6)).strftime('%Y-%m-%d')
+    month_start = (datetime.now() - timedelta(days=27)).strftime('%Y-%m-%d')
+    stats = {
+        'students': 0,
+        'tested': 0,
+        'napfa_total': 0,
+        'medals': {'Gold': 0, 'Silver': 0, 'Bronze': 0, 'No Medal': 0},
+        'component_grades': {c: 0 for c in NAPFA_COMPONENTS},
+        'component_weak': {c: 0 for c in NAPFA_COMPONENTS},
+        'active_week': 0,
+        'active_month': 0,
+        'workouts_month': 0,
+        'classes': {}
+    }
+    
+    for student in students:
+        class_stats = stats['classes'].setdefault(student.get('class') or 'Unassigned',
+                                                  {'students': 0, 'tested': 0, 'napfa_total': 0, 'gold': 0, 'active_week': 0})
+        stats['students'] += 1
+        class_stats['students'] += 1
+        
+        if student.get('napfa_history'):
+            latest = student['napfa_history'][-1]
+            stats['tested'] += 1
+            stats['napfa_total'] += latest['total']
+            class_stats['tested'] += 1
+            class_stats['napfa_total'] += latest['total']
+            
+            medal = next((m for m in ('Gold', 'Silver', 'Bronze') if m in latest['medal']), 'No Medal')
+            stats['medals'][medal] += 1
+            if medal == 'Gold':
+                class_stats['gold'] += 1
+            
+            for component in NAPFA_COMPONENTS:
+                grade = latest['grades'].get(component, 0)
+                stats['component_grades'][component] += grade
+                if grade < 3:
+                    stats['component_weak'][component] += 1
+        
+        recent = [e['date'] for e in student.get('exercises', []) if e['date'] >= month_start]
+        if recent:
+            stats['active_month'] += 1
+            stats['workouts_month'] += len(recent)
+            if max(recent) >= week_start:
+                stats['active_week'] += 1
+                class_stats['active_week'] += 1
+    
+    return stats
+
+@st.cache_data(ttl=3600, show_spinner="Crunching school data...")
+def compute_school_analytics(school, _users_data):
+    """School-wide NAPFA, weakness and participation aggregates, cached for an hour (per school)"""
+    students = [data for data in _users_data.values()
+                if data.get('role') != 'teacher' and data.get('school') == school]
+    stats = school_stats(students)
+    stats['computed'] = datetime.now().strftime('%Y-%m-%d %H:%M')
+    return stats
+
+def school_admin_dashboard(user_data, all_users):
+    """School-wide view across every class, for Heads of Department"""
+    st.subheader(f"🏫 {user_data.get('school', 'School')} Analytics")
+    
+    col1, col2 = st.columns([3, 1])
+    with col2:
+        if st.button("🔄 Refresh", key="refresh_school_analytics"):
+            compute_school_analytics.clear()
+    
+    stats = compute_school_analytics(user_data.get('school'), all_users)
+    with col1:
+        st.caption(f"Computed {stats['computed']} (cached for up to an hour)")
+    
+    if stats['students'] == 0:
+        st.info("No students registered for this school yet")
+        return
+    
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Students", stats['students'])
+    col2.metric("NAPFA Tested", f"{stats['tested']}/{stats['students']}")
+    col3.metric("Avg NAPFA", f"{stats['napfa_total'] / stats['tested']:.1f}/30" if stats['tested'] else "No data")
+    col4.metric("Active This Week", f"{stats['active_week'] / stats['students'] * 100:.0f}%")
+    
+    st.write("### 🏅 Medal Distribution")
+    st.bar_chart(pd.Series(stats['medals'], name='Students'))
+    
+    if stats['tested']:
+        st.write("### 📊 Component Weaknesses")
+        component_names = {code: name for name, code in NAPFA_REPORT_COLUMNS}
+        df_components = pd.DataFrame({
+            'Component': [component_names[c] for c in NAPFA_COMPONENTS],
+            'Average Grade': [stats['component_grades'][c] / stats['tested'] for c in NAPFA_COMPONENTS],
+            'Below Grade 3 (%)': [stats['component_weak'][c] / stats['tested'] * 100 for c in NAPFA_COMPONENTS]
+        }).set_index('Component')
+        st.bar_chart(df_components['Below Grade 3 (%)'])
+        st.dataframe(df_components.round(1), use_container_width=True)
+    
+    st.write("### 📈 Participation")
+    col1, col2 = st.columns(2)
+    col1.metric("Active in Last 4 Weeks", f"{stats['active_month']}/{stats['students']}")
+    col2.metric("Workouts in Last 4 Weeks", stats['workouts_month'])
+    
+    st.write("### 📚 Classes")
+    df_classes = pd.DataFrame([{
+        'Class': class_name,
+        'Students': c['students'],
+        'Avg NAPFA': round(c['napfa_total'] / c['tested'], 1) if c['tested'] else None,
+        'Gold': c['gold'],
+        'Active This Week (%)': round(c['active_week'] / c['students'] * 100)
+    } for class_name, c in stats['classes'].items()]).sort_values('Avg NAPFA', ascending=False)
+    st.dataframe(df_classes, use_container_width=True, hide_index=True)
+    
+    st.write("### ⚠️ Students Needing Attention")
+    if refresh_at_risk(user_data, all_users, 'school'):
+        update_user_data(user_data)
+    show_at_risk_table(user_data, all_users, 'school')
+    
+    st.write("### 📏 NAPFA Norms")
+    norms = load_norms()
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        if norms:
+            tests = int(sum(sum(sketch) for sketch in norms['schools'].get(user_data.get('school'), {}).values()) / len(NORM_BINS))
+            st.caption(f"Percentile norms cover about {tests} students at your school · last updated {norms['updated']}")
+        else:
+            st.caption("Percentile norms have not been built yet")
+    with col2:
+        if st.button("🔄 Rebuild Norms", key="rebuild_norms"):
+            rebuild_napfa_norms(all_users)
+            st.success("✅ Norms rebuilt from every student's latest test")
+    
+    st.write("### 😴 Sleep & Performance")
+    col1, col2 = st.columns([3, 1])
+    with col2:
+        force = st.button("🔄 Re-run Analysis", key="rebuild_sleep_model")
+    sleep_model = refresh_sleep_model(all_users, force=force)
+    with col1:
+        if sleep_model['computed'] is None:
+            st.caption("The sleep analysis is being computed in the background; check back shortly")
+        else:
+            st.caption(f"{sleep_model['samples']} NAPFA tests with {SLEEP_MODEL_MIN_NIGHTS}+ nights of sleep logged "
+                       f"in the {SLEEP_MODEL_WINDOW_DAYS} days before · computed {sleep_model['computed']}")
+    if sleep_model['cohorts']:
+        df_sleep = pd.DataFrame([{
+            'Cohort': describe_sleep_cohort(key).capitalize(),
+            'Tests': fit['n'],
+            'Points per Extra Hour': round(fit['slope'], 2),
+            '95% Range': (f"{fit['slope'] - 1.96 * fit['slope_se']:+.2f} to {fit['slope'] + 1.96 * fit['slope_se']:+.2f}"
+                          if fit['slope_se'] is not None else "-"),
+            'Correlation (r)': round(fit['r'], 2),
+            'Avg Sleep (h)': round(fit['mean_sleep'], 1)
+        } for key, fit in sleep_model['cohorts'].items()])
+        st.dataframe(df_sleep, use_container_width=True, hide_index=True)
+    else:
+        st.info(f"Each cohort needs {SLEEP_MODEL_MIN_SAMPLES}+ tests with sleep logged before them")
+    
+    requests = hod_requests(all_users, user_data.get('school'))
+    if requests:
+        st.write("### 🔑 Head of Department Requests")
+        for username, teacher in requests:
+            col1, col2, col3 = st.columns([3, 1, 1])
+            with col1:
+                st.write(f"**{teacher.get('name', username)}** ({teacher.get('email', '')}) · {teacher.get('department') or 'No department'}")
+            with col2:
+                if st.button("✅ Approve", key=f"approve_hod_{username}"):
+                    teacher['hod_granted_by'] = st.session_state.username
+                    teacher['hod_requested'] = False
+                    teacher.pop('is_hod', None)
+                    save_users(all_users)
+                    st.rerun()
+            with col3:
+                if st.button("❌ Decline", key=f"decline_hod_{username}"):
+                    teacher['hod_requested'] = False
+                    teacher.pop('is_hod', None)
+                    save_users(all_users)
+                    st.rerun()
+
+# Student Search
+def _search_tokens(text):
+    """Lower-case words of a name, username or email"""
+    return ''.join(c if c.isalnum() else ' ' for c in text.lower()).split()
+
+def _trigrams(token):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _within_edit_distance(a, b, limit):
+    """True if a and b are at most `limit` edits apart, counting swapped neighbours as one edit"""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    before, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i]
+        for j in range(1, len(b) + 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return False
+        before, previous = previous, current
+    return previous[-1] <= limit
+
+def build_student_search_index(users_data, usernames):
+    """Sorted token list for prefix search plus a trigram index for typo-tolerant matches"""
+    postings = {}
+    for username in usernames:
+        student = users_data.get(username)
+        if not student:
+            continue
+        for field in (student.get('name', ''), username, student.get('email', '').split('@')[0]):
+            for token in _search_tokens(field):
+                postings.setdefault(token, set()).add(username)
+    
+    trigrams = {}
+    for token in postings:
+        for trigram in _trigrams(token):
+            trigrams.setdefault(trigram, set()).add(token)
+    
+    return {'tokens': sorted(postings), 'postings': postings, 'trigrams': trigrams}
+
+def _match_term(index, term):
+    """Usernames matching one query word, scored 3 exact, 2 prefix, 1 typo match"""
+    matches = {}
+    tokens = index['tokens']
+    position = bisect.bisect_left(tokens, term)
+    while position < len(tokens) and tokens[position].startswith(term):
+        token = tokens[position]
+        for username in index['postings'][token]:
+            matches[username] = max(matches.get(username, 0), 3 if token == term else 2)
+        position += 1
+    
+    if not matches and len(term) >= 3:
+        # Only tokens sharing a trigram with the term are compared
+        limit = 1 if len(term) <= 5 else 2
+        candidates = set()
+        for trigram in _trigrams(term):
+            candidates.update(index['trigrams'].get(trigram, ()))
+        for token in candidates:
+            # Compare against the whole token and its start, so typos in a partial word still match
+            if _within_edit_distance(term, token, limit) or _within_edit_distance(term, token[:len(term)], limit):
+                for username in index['postings'][token]:
+                    matches[username] = max(matches.get(username, 0), 1)
+    return matches
+
+def search_students(index, query):
+    """Usernames matching every word of the query, best matches first"""
+    scores = None
+    for term in _search_tokens(query):
+        matches = _match_term(index, term)
+        if scores is None:
+            scores = matches
+        else:
+            scores = {u: scores[u] + matches[u] for u in scores.keys() & matches.keys()}
+    scores = scores or {}
+    return sorted(scores, key=lambda u: (-scores[u], u))
+
+# At-risk Detection
+# Batch job over a teacher's class or whole school, stored on the teacher record as a flag table
+AT_RISK_MAX_AGE_HOURS = 24
+AT_RISK_NAPFA_DROP = 3
+AT_RISK_INACTIVE_DAYS = 14
+AT_RISK_SLEEP_DAYS = 14
+AT_RISK_SLEEP_HOURS = 7
+AT_RISK_SLEEP_MIN_NIGHTS = 5
+
+AT_RISK_FLAGS = {
+    'declining': "📉 Declining NAPFA",
+    'component': "🚫 Component below grade 1",
+    'inactive': "💤 Inactive",
+    'short_sleep': "🌙 Short sleep",
+    'load_spike': "⚡ Training load spike"
+}
+
+def detect_at_risk(students):
+    """Flag students from (username, data) pairs in one vectorized pass, returns only flagged rows"""
+    students = list(students)
+    n = len(students)
+    today = np.datetime64(datetime.now().strftime('%Y-%m-%d'), 'D')
+    sleep_cutoff = (datetime.now() - timedelta(days=AT_RISK_SLEEP_DAYS)).strftime('%Y-%m-%d')
+    
+    totals = np.full(n, np.nan)
+    previous_totals = np.full(n, np.nan)
+    grades = np.full((n, len(NAPFA_COMPONENTS)), -1, dtype=np.int8)
+    last_workouts = np.full(n, np.datetime64('NaT'), dtype='datetime64[D]')
+    sleep_hours = np.zeros(n)
+    sleep_nights = np.zeros(n)
+    loads = np.zeros((n, 2))
+    
+    # Gather the few numbers each rule needs, everything else is array maths
+    for i, (username, student) in enumerate(students):
+        napfa_history = student.get('napfa_history', [])
+        if napfa_history:
+            totals[i] = napfa_history[-1]['total']
+            test_grades = napfa_history[-1]['grades']
+            grades[i] = [test_grades.get(component, -1) for component in NAPFA_COMPONENTS]
+            if len(napfa_history) > 1:
+                previous_totals[i] = napfa_history[-2]['total']
+        
+        exercises = student.get('exercises', [])
+        if exercises:
+            last_workouts[i] = max(exercise['date'] for exercise in exercises)
+            loads[i] = training_load_today(get_training_load(student))
+        
+        # Sleep is logged oldest first, so walk back from the end until the window is covered
+        for entry in reversed(student.get('sleep_history', [])):
+            if entry['date'] < sleep_cutoff:
+                break
+            sleep_hours[i] += entry['hours'] + entry.get('minutes', 0) / 60
+            sleep_nights[i] += 1
+    
+    tested = ~np.isnan(totals)
+    with np.errstate(invalid='ignore'):
+        drops = previous_totals - totals
+        declining = drops >= AT_RISK_NAPFA_DROP
+    
+    below_one = (grades == 0) & tested[:, None]
+    component = below_one.any(axis=1)
+    # Medal the total alone would earn against the medal the weak component allows
+    medal_with_components = napfa_medal_index(totals, np.where(grades < 0, 0, grades).min(axis=1))
+    medal_by_total = napfa_medal_index(totals, np.full(n, 5))
+    
+    days_inactive = np.where(np.isnat(last_workouts), np.inf, (today - last_workouts).astype('float64'))
+    inactive = days_inactive >= AT_RISK_INACTIVE_DAYS
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average_sleep = sleep_hours / sleep_nights
+    short_sleep = (sleep_nights >= AT_RISK_SLEEP_MIN_NIGHTS) & (average_sleep < AT_RISK_SLEEP_HOURS)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = loads[:, 0] / loads[:, 1]
+    load_spike = (loads[:, 1] > 0) & (ratios >= ACWR_ZONES[2][0])
+    
+    rows = []
+    for i in np.flatnonzero(declining | component | inactive | short_sleep | load_spike):
+        username, student = students[i]
+        flags, details = [], []
+        if declining[i]:
+            flags.append('declining')
+            details.append(f"NAPFA down {drops[i]:.0f} points to {totals[i]:.0f}/30")
+        if component[i]:
+            flags.append('component')
+            weak = ', '.join(c for c, low in zip(NAPFA_COMPONENTS, below_one[i]) if low)
+            detail = f"Grade 0 in {weak}"
+            if medal_by_total[i] < medal_with_components[i]:
+                detail += f" (costing a {NAPFA_MEDALS[medal_by_total[i]][0]})"
+            details.append(detail)
+        if inactive[i]:
+            flags.append('inactive')
+            details.append("No workouts logged" if np.isinf(days_inactive[i])
+                           else f"No workout for {days_inactive[i]:.0f} days")
+        if short_sleep[i]:
+            flags.append('short_sleep')
+            details.append(f"Averaging {average_sleep[i]:.1f}h sleep over {sleep_nights[i]:.0f} nights")
+        if load_spike[i]:
+            flags.append('load_spike')
+            details.append(f"Acute:chronic load ratio {ratios[i]:.2f}")
+        rows.append({
+            'username': username,
+            'name': student.get('name', ''),
+            'class': student.get('class', ''),
+            'flags': flags,
+            'details': details
+        })
+    
+    return rows
+
+def refresh_at_risk(teacher_data, users_data, scope, force=False):
+    """Recompute the stored 'class' or 'school' flag table when missing or stale, returns True if it changed"""
+    table = teacher_data.setdefault('at_risk', {}).get(scope)
+    if table and not force:
+        age = datetime.now() - datetime.strptime(table['computed'], '%Y-%m-%d %H:%M')
+        if age < timedelta(hours=AT_RISK_MAX_AGE_HOURS):
+            return False
+    
+    if scope == 'school':
+        students = iter_school_students(users_data, teacher_data.get('school'))
+    else:
+        students = ((username, users_data[username]) for username in teacher_data.get('students', [])
+                    if username in users_data)
+    
+    teacher_data['at_risk'][scope] = {
+        'computed': datetime.now().strftime('%Y-%m-%d %H:%M'),
+        'rows': detect_at_risk(students)
+    }
+    return True
+
+def show_at_risk_table(teacher_data, users_data, scope):
+    """Render a stored flag table with a filter and a re-run button"""
+    table = teacher_data['at_risk'][scope]
+    rows = table['rows']
+    
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        st.caption(f"{len(rows)} students flagged · computed {table['computed']}")
+    with col2:
+        if st.button("🔄 Re-run Analysis", key=f"rerun_at_risk_{scope}"):
+            refresh_at_risk(teacher_data, users_data, scope, force=True)
+            update_user_data(teacher_data)
+            st.rerun()
+    
+    if not rows:
+        st.success("✅ All students doing well!")
+        return
+    
+    selected = st.multiselect("Show flags", list(AT_RISK_FLAGS.keys()), default=list(AT_RISK_FLAGS.keys()),
+                              format_func=lambda f: AT_RISK_FLAGS[f], key=f"at_risk_filter_{scope}")
+    shown = [row for row in rows if set(row['flags']) & set(selected)]
+    
+    df = pd.DataFrame([{
+        'Student': row['name'],
+        'Username': row['username'],
+        'Class': row['class'],
+        'Flags': ' '.join(AT_RISK_FLAGS[f].split()[0] for f in row['flags']),
+        'Details': '; '.join(row['details'])
+    } for row in shown], columns=['Student', 'Username', 'Class', 'Flags', 'Details'])
+    st.dataframe(df, use_container_width=True, hide_index=True)
+
+# Student Query Builder
+# Filters compile to boolean masks over a per-class DataFrame built from the class summary
+QUERY_FIELDS = {
+    'age': ('Age', 'number'),
+    'gender': ('Gender', 'choice'),
+    'total_workouts': ('Total workouts', 'number'),
+    'days_inactive': ('Days since last workout', 'number'),
+    'napfa_total': ('Latest NAPFA total', 'number'),
+    'medal': ('Latest NAPFA medal', 'choice'),
+    'SU': ('Sit-Ups grade', 'number'),
+    'SBJ': ('Broad Jump grade', 'number'),
+    'SAR': ('Sit & Reach grade', 'number'),
+    'PU': ('Pull-Ups grade', 'number'),
+    'SR': ('Shuttle Run grade', 'number'),
+    'RUN': ('2.4km Run grade', 'number')
+}
+
+QUERY_CHOICES = {
+    'gender': {'m': 'Male', 'f': 'Female'},
+    'medal': {'🥇 Gold': 'Gold', '🥈 Silver': 'Silver', '🥉 Bronze': 'Bronze', 'No Medal': 'No Medal'}
+}
+
+QUERY_OPERATORS = {
+    'number': ['<', '<=', '=', '>=', '>'],
+    'choice': ['is', 'is not']
+}
+
+def build_class_frame(summary_rows):
+    """One row per student with the columns the query builder can filter on"""
+    today = np.datetime64(datetime.now().strftime('%Y-%m-%d'), 'D')
+    records = []
+    for username, row in summary_rows.items():
+        napfa = row.get('napfa') or {}
+        record = {
+            'username': username,
+            'name': row.get('name', ''),
+            'age': row.get('age'),
+            'gender': row.get('gender'),
+            'total_workouts': row.get('total_workouts', 0),
+            'last_workout': row.get('last_workout'),
+            'napfa_total': napfa.get('total'),
+            'medal': napfa.get('medal')
+        }
+        grades = regrade_napfa_test(napfa) if napfa else {}
+        for component in NAPFA_COMPONENTS:
+            record[component] = grades.get(component)
+        records.append(record)
+    
+    columns = ['username', 'name', 'age', 'gender', 'total_workouts', 'last_workout', 'napfa_total', 'medal'] + NAPFA_COMPONENTS
+    df = pd.DataFrame.from_records(records, columns=columns)
+    for column in ['age', 'total_workouts', 'napfa_total'] + NAPFA_COMPONENTS:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    
+    # Students who never worked out count as inactive forever
+    last = pd.to_datetime(df['last_workout'], errors='coerce').to_numpy(dtype='datetime64[D]')
+    df['days_inactive'] = np.where(np.isnat(last), np.inf, (today - last).astype('float64'))
+    return df
+
+def compile_query(conditions):
+    """Turn [{'field', 'op', 'value'}, ...] into a function returning the matching rows of a class frame"""
+    comparisons = {
+        '<': lambda column, value: column < value,
+        '<=': lambda column, value: column <= value,
+        '=': lambda column, value: column == value,
+        '>=': lambda column, value: column >= value,
+        '>': lambda column, value: column > value,
+        'is': lambda column, value: column == value,
+        'is not': lambda column, value: column != value
+    }
+    steps = [(condition['field'], comparisons[condition['op']], condition['value']) for condition in conditions]
+    
+    def run(df):
+        mask = np.ones(len(df), dtype=bool)
+        for field, compare, value in steps:
+            # Missing values (no NAPFA test yet) never satisfy a numeric condition
+            mask &= compare(df[field], value).to_numpy(dtype=bool)
+        return df[mask]
+    return run
+
+def describe_condition(condition):
+    label, kind = QUERY_FIELDS[condition['field']]
+    value = QUERY_CHOICES[condition['field']][condition['value']] if kind == 'choice' else condition['value']
+    return f"{label} {condition['op']} {value}"
+
+def student_query_builder(user_data, summary_rows):
+    """Filter builder over the teacher's class with saved queries and CSV export"""
+    st.write("Combine conditions to find students, e.g. 14-year-old girls with a 2.4km Run grade below 3 "
+             "who haven't worked out in 10 days.")
+    
+    conditions = st.session_state.setdefault('query_conditions', [])
+    saved_queries = user_data.setdefault('saved_queries', [])
+    
+    if saved_queries:
+        col1, col2, col3 = st.columns([3, 1, 1])
+        with col1:
+            saved_name = st.selectbox("Saved queries", [q['name'] for q in saved_queries], key="saved_query_select")
+        with col2:
+            if st.button("📂 Load", key="load_saved_query"):
+                st.session_state.query_conditions = [dict(c) for q in saved_queries if q['name'] == saved_name
+                                                     for c in q['conditions']]
+                st.rerun()
+        with col3:
+            if st.button("🗑️ Delete", key="delete_saved_query"):
+                user_data['saved_queries'] = [q for q in saved_queries if q['name'] != saved_name]
+                update_user_data(user_data)
+                st.rerun()
+    
+    # Add a condition
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
+    with col1:
+        field = st.selectbox("Field", list(QUERY_FIELDS.keys()), format_func=lambda f: QUERY_FIELDS[f][0],
+                             key="query_field")
+    kind = QUERY_FIELDS[field][1]
+    with col2:
+        op = st.selectbox("Condition", QUERY_OPERATORS[kind], key=f"query_op_{kind}")
+    with col3:
+        if kind == 'choice':
+            value = st.selectbox("Value", list(QUERY_CHOICES[field].keys()),
+                                 format_func=lambda v: QUERY_CHOICES[field][v], key=f"query_value_{field}")
+        else:
+            value = st.number_input("Value", min_value=0, max_value=1000, value=0, step=1, key="query_value_number")
+    with col4:
+        st.write("")
+        if st.button("➕ Add", key="add_query_condition"):
+            conditions.append({'field': field, 'op': op, 'value': value})
+            st.rerun()
+    
+    if not conditions:
+        st.info("Add a condition to start filtering")
+        return
+    
+    for idx, condition in enumerate(conditions):
+        col1, col2 = st.columns([5, 1])
+        with col1:
+            st.write(f"{'Where' if idx == 0 else 'and'} **{describe_condition(condition)}**")
+        with col2:
+            if st.button("✖", key=f"remove_query_condition_{idx}"):
+                conditions.pop(idx)
+                st.rerun()
+    
+    # Cached until the users data is reloaded, so editing conditions doesn't rebuild it
+    class_frame = get_users_index(f"class_frame_{st.session_state.username}",
+                                  lambda users: build_class_frame(summary_rows))
+    results = compile_query(conditions)(class_frame)
+    
+    st.write(f"**{len(results)} of {len(class_frame)} students match**")
+    if len(results) > 0:
+        display = results.drop(columns=['days_inactive']).copy()
+        display['gender'] = display['gender'].map(QUERY_CHOICES['gender'])
+        display[['age', 'napfa_total'] + NAPFA_COMPONENTS] = display[['age', 'napfa_total'] + NAPFA_COMPONENTS].astype('Int64')
+        st.dataframe(display, use_container_width=True, hide_index=True)
+        st.download_button(
+            label="📥 Download Results (CSV)",
+            data=results.drop(columns=['days_inactive']).to_csv(index=False),
+            file_name=f"student_query_{datetime.now().strftime('%Y%m%d')}.csv",
+            mime="text/csv",
+            key="download_query_results"
+        )
+    
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        query_name = st.text_input("Save this query as", placeholder="e.g., Inactive girls weak at RUN",
+                                   key="query_name")
+    with col2:
+        st.write("")
+        if st.button("💾 Save Query", key="save_query"):
+            if not query_name:
+                st.error("Please enter a name for the query")
+            else:
+                user_data['saved_queries'] = [q for q in saved_queries if q['name'] != query_name] + [
+                    {'name': query_name, 'conditions': [dict(c) for c in conditions]}
+                ]
+                update_user_data(user_data)
+                st.success(f"✅ Saved query '{query_name}'")
+
 # Teacher Dashboard
 def teacher_dashboard():
     st.header("👨‍🏫 Teacher Dashboard")
@@ -4872,28 +7630,44 @@ def teacher_dashboard():
     students_data = {username: all_users[username] for username in student_usernames if username in all_users}
     
     # Create tabs
-    tab1, tab2, tab3, tab4 = st.tabs([
+    tab_names = [
         "📊 Class Overview",
         "👥 Student List", 
         "📈 Performance Analysis",
-        "📄 Export Reports"
-    ])
+        "📄 Export Reports",
+        "⚡ Class Challenges",
+        "📥 NAPFA Upload"
+    ]
+    is_hod = is_head_of_department(user_data)
+    if is_hod:
+        tab_names.append("🏫 School Analytics")
+    elif user_data.get('hod_requested') or user_data.get('is_hod'):
+        st.info("🔑 Your Head of Department access request is waiting for approval by an HOD at your school.")
+    
+    tabs = st.tabs(tab_names)
+    tab1, tab2, tab3, tab4, tab5, tab6 = tabs[:6]
+    
+    if is_hod:
+        with tabs[6]:
+            school_admin_dashboard(user_data, all_users)
     
     with tab1:
         st.subheader("Class Overview")
         
+        # Read from the materialized class summary instead of every student's history
+        if refresh_class_summary(user_data, all_users):
+            update_user_data(user_data)
+        summary_rows = user_data['class_summary']['students']
+        
         # Stats
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Total Students", f"{len(students_data)}/30")
+            st.metric("Total Students", f"{len(summary_rows)}/30")
         
         with col2:
             # Calculate average NAPFA
-            napfa_scores = []
-            for student in students_data.values():
-                if student.get('napfa_history'):
-                    napfa_scores.append(student['napfa_history'][-1]['total'])
+            napfa_scores = [row['napfa']['total'] for row in summary_rows.values() if row['napfa']]
             
             if napfa_scores:
                 avg_napfa = sum(napfa_scores) / len(napfa_scores)
@@ -4902,26 +7676,17 @@ def teacher_dashboard():
                 st.metric("Avg NAPFA Score", "No data")
         
         with col3:
-            # Active this week
-            week_ago = datetime.now() - timedelta(days=7)
-            active_count = 0
-            for student in students_data.values():
-                if student.get('exercises'):
-                    for exercise in student['exercises']:
-                        if datetime.strptime(exercise['date'], '%Y-%m-%d') >= week_ago:
-                            active_count += 1
-                            break
+            # Active this week (dates are YYYY-MM-DD so they compare as strings)
+            week_start = (datetime.now() - timedelta(days=6)).strftime('%Y-%m-%d')
+            active_count = sum(1 for row in summary_rows.values() 
+                               if row['last_workout'] and row['last_workout'] >= week_start)
             
-            st.metric("Active This Week", f"{active_count}/{len(students_data)}")
+            st.metric("Active This Week", f"{active_count}/{len(summary_rows)}")
         
         with col4:
             # Total workouts this week
-            total_workouts = 0
-            for student in students_data.values():
-                if student.get('exercises'):
-                    weekly = [e for e in student['exercises'] 
-                            if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                    total_workouts += len(weekly)
+            total_workouts = sum(count for row in summary_rows.values() 
+                                 for date, count in row['recent_workouts'].items() if date >= week_start)
             
             st.metric("Class Workouts", total_workouts)
         
@@ -4939,9 +7704,9 @@ def teacher_dashboard():
             st.write("### 🏅 Medal Distribution")
             
             medal_counts = {'🥇 Gold': 0, '🥈 Silver': 0, '🥉 Bronze': 0, 'No Medal': 0}
-            for student in students_data.values():
-                if student.get('napfa_history'):
-                    medal = student['napfa_history'][-1]['medal']
+            for row in summary_rows.values():
+                if row['napfa']:
+                    medal = row['napfa']['medal']
                     if '🥇' in medal:
                         medal_counts['🥇 Gold'] += 1
                     elif '🥈' in medal:
@@ -4962,15 +7727,12 @@ def teacher_dashboard():
             st.write("")
             st.write("### ⭐ Top Performers")
             
-            student_scores = []
-            for username, student in students_data.items():
-                if student.get('napfa_history'):
-                    student_scores.append({
-                        'name': student['name'],
-                        'username': username,
-                        'score': student['napfa_history'][-1]['total'],
-                        'medal': student['napfa_history'][-1]['medal']
-                    })
+            student_scores = [{
+                'name': row['name'],
+                'username': username,
+                'score': row['napfa']['total'],
+                'medal': row['napfa']['medal']
+            } for username, row in summary_rows.items() if row['napfa']]
             
             student_scores.sort(key=lambda x: x['score'], reverse=True)
             
@@ -4982,21 +7744,19 @@ def teacher_dashboard():
         st.write("")
         st.write("### ⚠️ Students Needing Attention")
         
-        needs_attention = []
-        for username, student in students_data.items():
-            # Check if inactive
-            if not student.get('exercises') or len(student.get('exercises', [])) == 0:
-                needs_attention.append(f"📝 **{student['name']}** - No workouts logged")
-            elif student.get('napfa_history'):
-                latest_napfa = student['napfa_history'][-1]
-                if latest_napfa['total'] < 9:
-                    needs_attention.append(f"📉 **{student['name']}** - Low NAPFA score ({latest_napfa['total']}/30)")
-        
-        if needs_attention:
-            for msg in needs_attention[:5]:
-                st.warning(msg)
-        else:
-            st.success("✅ All students doing well!")
+        if refresh_at_risk(user_data, all_users, 'class'):
+            update_user_data(user_data)
+        show_at_risk_table(user_data, all_users, 'class')
+        
+        st.write("")
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.caption(f"Summary last updated: {user_data['class_summary']['updated'] or 'never'}")
+        with col2:
+            if st.button("🔄 Rebuild Summary", key="rebuild_class_summary"):
+                refresh_class_summary(user_data, all_users, rebuild=True)
+                update_user_data(user_data)
+                st.rerun()
     
     with tab2:
         st.subheader("Student List")
@@ -5005,44 +7765,61 @@ def teacher_dashboard():
             st.info("No students in your class yet. Share your class code: " + user_data['class_code'])
         else:
             # Search and filter
-            search = st.text_input("🔍 Search students", placeholder="Enter name or username")
+            search = st.text_input("🔍 Search students", placeholder="Enter name, username or email")
+            
+            if search.strip():
+                search_index = get_users_index(f"student_search_{st.session_state.username}",
+                                               lambda users: build_student_search_index(users, students_data))
+                matching = search_students(search_index, search)
+                if not matching:
+                    st.info("No students match your search")
+            else:
+                matching = list(students_data)
+            
+            start, end = paginate(len(matching), "student_list_page", reset_on=search)
             
             # Display students
-            for username, student in students_data.items():
-                if search.lower() in student['name'].lower() or search.lower() in username.lower() or not search:
-                    with st.expander(f"👤 {student['name']} (@{username})"):
-                        col1, col2, col3 = st.columns(3)
-                        
-                        with col1:
-                            st.write(f"**Email:** {student.get('email', 'N/A')}")
-                            st.write(f"**Age:** {student.get('age', 'N/A')}")
-                            st.write(f"**Gender:** {'Male' if student.get('gender') == 'm' else 'Female'}")
-                        
-                        with col2:
-                            if student.get('napfa_history'):
-                                latest = student['napfa_history'][-1]
-                                st.write(f"**NAPFA:** {latest['total']}/30")
-                                st.write(f"**Medal:** {latest['medal']}")
-                            else:
-                                st.write("**NAPFA:** Not tested")
-                            
-                            st.write(f"**Workouts:** {len(student.get('exercises', []))}")
-                        
-                        with col3:
-                            st.write(f"**Level:** {student.get('level', 'Novice')}")
-                            st.write(f"**Points:** {student.get('total_points', 0)}")
-                            st.write(f"**Login Streak:** {student.get('login_streak', 0)} days")
+            for username in matching[start:end]:
+                student = students_data[username]
+                with st.expander(f"👤 {student['name']} (@{username})"):
+                    col1, col2, col3 = st.columns(3)
+                    
+                    with col1:
+                        st.write(f"**Email:** {student.get('email', 'N/A')}")
+                        st.write(f"**Age:** {student.get('age', 'N/A')}")
+                        st.write(f"**Gender:** {'Male' if student.get('gender') == 'm' else 'Female'}")
+                    
+                    with col2:
+                        if student.get('napfa_history'):
+                            latest = student['napfa_history'][-1]
+                            st.write(f"**NAPFA:** {latest['total']}/30")
+                            st.write(f"**Medal:** {latest['medal']}")
+                        else:
+                            st.write("**NAPFA:** Not tested")
                         
-                        # Quick actions
-                        st.write("")
-                        if st.button(f"Remove from class", key=f"remove_{username}"):
-                            user_data['students'].remove(username)
-                            student['teacher_class'] = None
-                            update_user_data(user_data)
-                            save_users(all_users)
-                            st.success(f"Removed {student['name']} from class")
-                            st.rerun()
-    
+                        st.write(f"**Workouts:** {len(student.get('exercises', []))}")
+                    
+                    with col3:
+                        st.write(f"**Level:** {student.get('level', 'Novice')}")
+                        st.write(f"**Points:** {student.get('total_points', 0)}")
+                        st.write(f"**Login Streak:** {student.get('login_streak', 0)} days")
+                    
+                    # Quick actions
+                    st.write("")
+                    if st.button(f"Remove from class", key=f"remove_{username}"):
+                        user_data['students'].remove(username)
+                        user_data.get('class_summary', {}).get('students', {}).pop(username, None)
+                        student['teacher_class'] = None
+                        update_user_data(user_data)
+                        save_users(all_users)
+                        st.success(f"Removed {student['name']} from class")
+                        st.rerun()
+            
+            # Query builder
+            st.write("")
+            st.write("### 🔎 Query Builder")
+            student_query_builder(user_data, user_data['class_summary']['students'])
+
     with tab3:
         st.subheader("Performance Analysis")
         
@@ -5052,36 +7829,29 @@ def teacher_dashboard():
             # NAPFA component analysis
             st.write("### 📊 NAPFA Component Breakdown")
             
-            component_scores = {
-                'Sit-Ups': [],
-                'Broad Jump': [],
-                'Sit & Reach': [],
-                'Pull-Ups': [],
-                'Shuttle Run': [],
-                '2.4km Run': []
-            }
+            # Cached until the users data is reloaded, so filters and sorting only slice the array
+            matrix = get_users_index(f"class_grade_matrix_{st.session_state.username}",
+                                     lambda users: build_grade_matrix(user_data['class_summary']['students']))
+            component_names = {code: name for name, code in NAPFA_REPORT_COLUMNS}
             
-            component_map = {
-                'SU': 'Sit-Ups',
-                'SBJ': 'Broad Jump',
-                'SAR': 'Sit & Reach',
-                'PU': 'Pull-Ups',
-                'SR': 'Shuttle Run',
-                'RUN': '2.4km Run'
-            }
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                gender_filter = st.selectbox("Students", ["All", "Male", "Female"], key="matrix_gender")
+            with col2:
+                sort_component = st.selectbox("Sort by", NAPFA_COMPONENTS, format_func=lambda c: component_names[c],
+                                              key="matrix_sort")
+            with col3:
+                weakest_first = st.checkbox("Weakest first", value=True, key="matrix_weakest_first")
             
-            for student in students_data.values():
-                if student.get('napfa_history'):
-                    grades = student['napfa_history'][-1]['grades']
-                    for code, name in component_map.items():
-                        if code in grades:
-                            component_scores[name].append(grades[code])
-            
-            if any(component_scores.values()):
-                # Calculate averages
-                avg_scores = {name: sum(scores)/len(scores) if scores else 0 
-                            for name, scores in component_scores.items()}
-                
+            mask = (matrix['grades'] >= 0).all(axis=1)
+            if gender_filter != "All":
+                mask &= matrix['genders'] == ('m' if gender_filter == "Male" else 'f')
+            grades = matrix['grades'][mask]
+            
+            if len(grades) == 0:
+                st.info("No NAPFA results for these students yet")
+            else:
+                avg_scores = dict(zip([component_names[c] for c in NAPFA_COMPONENTS], grades.mean(axis=0)))
                 df = pd.DataFrame({
                     'Component': list(avg_scores.keys()),
                     'Average Grade': list(avg_scores.values())
@@ -5094,33 +7864,114 @@ def teacher_dashboard():
                 if weak_components:
                     st.warning(f"⚠️ **Class weak areas:** {', '.join(weak_components)}")
                     st.info("💡 Consider focusing class training on these components")
+                
+                st.write("#### Grade Distribution")
+                df_distribution = pd.DataFrame(grade_distribution(grades).T,
+                                               index=[component_names[c] for c in NAPFA_COMPONENTS],
+                                               columns=[f"Grade {g}" for g in range(6)])
+                st.bar_chart(df_distribution)
+                
+                st.write("#### Student Heatmap")
+                column = NAPFA_COMPONENTS.index(sort_component)
+                order = np.argsort(grades[:, column] if weakest_first else -grades[:, column], kind='stable')
+                df_heatmap = pd.DataFrame(grades[order], columns=NAPFA_COMPONENTS)
+                df_heatmap.insert(0, 'Student', matrix['names'][mask][order])
+                df_heatmap['Total'] = grades[order].sum(axis=1)
+                st.dataframe(df_heatmap.style.map(_grade_cell_style, subset=NAPFA_COMPONENTS),
+                             use_container_width=True, hide_index=True)
+            
+            # Medal gaps across the class
+            st.write("")
+            st.write("### 🧭 Medal Gaps")
+            
+            gap_rows = []
+            for username, student in students_data.items():
+                if not student.get('napfa_history'):
+                    continue
+                latest = student['napfa_history'][-1]
+                if not has_napfa_standards(latest['age'], latest['gender'], napfa_test_version(latest)):
+                    continue
+                plans = medal_gap_plans(latest, student['napfa_history'])
+                if not plans:
+                    continue
+                next_medal, changes = plans[-1]
+                gap_rows.append({
+                    'Student': student['name'],
+                    'Current Medal': latest['medal'],
+                    'Next Medal': next_medal,
+                    'Components to Improve': len(changes),
+                    'Targets': '; '.join(describe_gap_change(change) for change in changes)
+                })
+            
+            if gap_rows:
+                df_gaps = pd.DataFrame(gap_rows).sort_values('Components to Improve', kind='stable')
+                st.dataframe(df_gaps, use_container_width=True, hide_index=True)
+                st.caption("Students closest to their next medal are listed first")
+            elif any(student.get('napfa_history') for student in students_data.values()):
+                st.success("🏆 Every tested student already has Gold!")
+            
+            # Trend projections for the whole class in one batched fit
+            st.write("")
+            st.write("### 🔮 NAPFA Projections")
+            
+            retested = [(username, student) for username, student in students_data.items()
+                        if len(student.get('napfa_history', [])) >= 2]
+            if not retested:
+                st.info("Projections appear once students have taken at least two NAPFA tests")
+            else:
+                projection_months = st.selectbox("Project ahead", [1, 3, 6], index=1, key="projection_months",
+                                                 format_func=lambda m: f"{m} month{'s' if m > 1 else ''}")
+                fit = fit_napfa_trends([student['napfa_history'] for _, student in retested])
+                predicted, lower, upper = predict_napfa_trends(fit, 30 * projection_months)
+                _, gold_total, gold_grade, _ = NAPFA_MEDALS[0]
+                days_to_gold = days_to_medal(fit, gold_total, gold_grade)
+                
+                df_projection = pd.DataFrame({
+                    'Student': [student['name'] for _, student in retested],
+                    'Tests': fit['count'],
+                    'Latest': [student['napfa_history'][-1]['total'] for _, student in retested],
+                    'Trend (pts/month)': np.round(fit['slope'][:, 0] * 30, 2),
+                    'Projected': np.round(predicted[:, 0], 1),
+                    '95% Range': [f"{lo:.0f}-{hi:.0f}" if np.isfinite(lo) else "Needs 3+ tests"
+                                  for lo, hi in zip(lower[:, 0], upper[:, 0])],
+                    'Gold In (months)': [round(d / 30, 1) if np.isfinite(d) else None for d in days_to_gold]
+                }).sort_values('Trend (pts/month)')
+                st.dataframe(df_projection, use_container_width=True, hide_index=True)
+                st.caption("Least-squares line through each student's tests. Gold needs the total and every component grade on track.")
+            
+            # Fitness-fatigue readiness for the whole class in one batched fit
+            st.write("")
+            st.write("### 🔋 Readiness")
+            
+            training = [(username, student) for username, student in students_data.items() if student.get('exercises')]
+            if not training:
+                st.info("Readiness appears once students have logged workouts")
+            else:
+                model = fit_banister([(student['exercises'], student.get('napfa_history', [])) for _, student in training])
+                form = banister_form(model)
+                df_readiness = pd.DataFrame({
+                    'Student': [student['name'] for _, student in training],
+                    'Model': np.where(model['fitted'], "Personal", "Standard"),
+                    'Fitness': np.round(model['fitness']),
+                    'Fatigue': np.round(model['fatigue']),
+                    'Form': np.round(form, 1),
+                    'Readiness (/30)': np.round(np.clip(model['p0'] + form, 0, 30), 1)
+                }).sort_values(['Model', 'Form'], kind='stable')
+                st.dataframe(df_readiness, use_container_width=True, hide_index=True)
+                st.caption(f"Fitness-fatigue model. Personal models need {BANISTER_MIN_TESTS}+ NAPFA tests and give form and "
+                           "readiness in NAPFA points; within each model the most fatigued students are listed first.")
             
             # Participation trends
             st.write("")
             st.write("### 📈 Weekly Participation Trend")
             
-            # Last 4 weeks
-            weeks_data = []
-            for week in range(4):
-                week_start = datetime.now() - timedelta(days=7 * (week + 1))
-                week_end = datetime.now() - timedelta(days=7 * week)
-                
-                active_count = 0
-                for student in students_data.values():
-                    if student.get('exercises'):
-                        for exercise in student['exercises']:
-                            ex_date = datetime.strptime(exercise['date'], '%Y-%m-%d')
-                            if week_start <= ex_date < week_end:
-                                active_count += 1
-                                break
-                
-                weeks_data.append({
-                    'Week': f"Week {4-week}",
-                    'Active Students': active_count
-                })
+            trend_window = st.selectbox("Period", list(PARTICIPATION_WINDOWS.keys()), key="participation_window")
+            df_weeks = participation_trend(students_data, PARTICIPATION_WINDOWS[trend_window])
+            st.line_chart(df_weeks)
             
-            df_weeks = pd.DataFrame(weeks_data)
-            st.line_chart(df_weeks.set_index('Week'))
+            if len(students_data) > 0:
+                avg_rate = df_weeks['Active Students'].mean() / len(students_data) * 100
+                st.caption(f"On average {avg_rate:.0f}% of the class was active each week over the last {trend_window}")
     
     with tab4:
         st.subheader("Export Class Reports")
@@ -5129,70 +7980,64 @@ def teacher_dashboard():
         st.info("Generate a comprehensive class report and export to Google Sheets")
         
         # Report options
+        col1, col2 = st.columns(2)
+        with col1:
+            # Other classes' names, emails and histories are for HODs only
+            report_scopes = ["My class", "Whole school"] if is_hod else ["My class"]
+            report_scope = st.selectbox("Students", report_scopes, key="report_scope")
+        with col2:
+            report_format = st.selectbox("Format", list(REPORT_FORMATS.keys()), key="report_format")
+        
         include_napfa = st.checkbox("Include NAPFA scores", value=True)
         include_workouts = st.checkbox("Include workout logs", value=True)
         include_attendance = st.checkbox("Include attendance/participation", value=True)
+        include_history = st.checkbox("Include full history (every workout, NAPFA test, sleep and BMI record)", value=False)
         
-        if st.button("📄 Generate Report (Download CSV)", type="primary"):
-            if not students_data:
+        if report_scope == "My class":
+            def report_students():
+                return iter(students_data.items())
+            student_count = len(students_data)
+        else:
+            def report_students():
+                return iter_school_students(all_users, user_data.get('school'))
+            student_count = len(get_membership_index()['school'].get(user_data.get('school'), set()))
+        
+        options = (include_napfa, include_workouts, include_attendance, include_history)
+        
+        if st.button("📄 Generate Report", type="primary"):
+            if student_count == 0:
                 st.error("No students to export")
             else:
-                # Generate report data
-                report_data = []
+                extension, mime = REPORT_FORMATS[report_format]
+                columns = report_columns(*options)
                 
-                for username, student in students_data.items():
-                    row = {
-                        'Name': student['name'],
-                        'Email': student.get('email', ''),
-                        'Age': student.get('age', ''),
-                        'Gender': 'Male' if student.get('gender') == 'm' else 'Female'
-                    }
-                    
-                    if include_napfa and student.get('napfa_history'):
-                        latest = student['napfa_history'][-1]
-                        row['NAPFA Total'] = latest['total']
-                        row['Medal'] = latest['medal']
-                        row['Sit-Ups'] = latest['grades'].get('SU', 0)
-                        row['Broad Jump'] = latest['grades'].get('SBJ', 0)
-                        row['Sit & Reach'] = latest['grades'].get('SAR', 0)
-                        row['Pull-Ups'] = latest['grades'].get('PU', 0)
-                        row['Shuttle Run'] = latest['grades'].get('SR', 0)
-                        row['2.4km Run'] = latest['grades'].get('RUN', 0)
-                    
-                    if include_workouts:
-                        row['Total Workouts'] = len(student.get('exercises', []))
+                # Rows are written to disk as they are generated instead of being collected first
+                with tempfile.TemporaryFile() as report_file:
+                    try:
+                        row_count = write_report(iter_report_rows(report_students(), *options),
+                                                 columns, extension, report_file)
+                    except ImportError as e:
+                        st.error(f"{report_format} export needs an extra package: {e.name} (pip install {e.name})")
+                    else:
+                        report_file.seek(0)
+                        st.download_button(
+                            label=f"📥 Download {report_format} Report",
+                            data=report_file.read(),
+                            file_name=f"class_report_{datetime.now().strftime('%Y%m%d')}.{extension}",
+                            mime=mime
+                        )
                         
-                        # This week
-                        week_ago = datetime.now() - timedelta(days=7)
-                        weekly = [e for e in student.get('exercises', []) 
-                                if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                        row['Workouts This Week'] = len(weekly)
-                    
-                    if include_attendance:
-                        row['Login Streak'] = student.get('login_streak', 0)
-                        row['Level'] = student.get('level', 'Novice')
-                        row['Total Points'] = student.get('total_points', 0)
-                    
-                    report_data.append(row)
-                
-                # Create DataFrame
-                df_report = pd.DataFrame(report_data)
-                
-                # Convert to CSV
-                csv = df_report.to_csv(index=False)
-                
-                st.download_button(
-                    label="📥 Download CSV Report",
-                    data=csv,
-                    file_name=f"class_report_{datetime.now().strftime('%Y%m%d')}.csv",
-                    mime="text/csv"
-                )
-                
-                st.success("✅ Report generated! Click to download.")
-                
-                # Preview
-                st.write("### Preview")
-                st.dataframe(df_report, use_container_width=True)
+                        st.success(f"✅ Report generated ({row_count} rows for {student_count} students)! Click to download.")
+                        
+                        # Preview
+                        st.write("### Preview")
+                        preview_rows = []
+                        for row in iter_report_rows(report_students(), *options):
+                            preview_rows.append(row)
+                            if len(preview_rows) >= 20:
+                                break
+                        st.dataframe(pd.DataFrame(preview_rows, columns=[name for name, _ in columns]),
+                                     use_container_width=True)
         
         st.write("")
         st.write("### 📧 Share Instructions")
@@ -5206,6 +8051,128 @@ def teacher_dashboard():
         
         **For automatic Google Sheets export, this feature will be available after deployment.**
         """)
+    
+    with tab5:
+        st.subheader("Class Challenges")
+        st.write("Weekly challenges you set appear for every student in your class alongside the built-in ones.")
+        
+        with st.form("class_challenge_form"):
+            challenge_name = st.text_input("Challenge Name", placeholder="e.g., PE Week Push")
+            challenge_description = st.text_input("Description", placeholder="e.g., Log 4 workouts before Friday")
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                challenge_type = st.selectbox("Measure", list(CHALLENGE_TYPES.keys()),
+                                              format_func=lambda t: CHALLENGE_TYPES[t])
+            with col2:
+                challenge_target = st.number_input("Weekly Target", min_value=1, max_value=1000, value=3)
+            with col3:
+                challenge_points = st.number_input("Points", min_value=5, max_value=200, value=30, step=5)
+            
+            submitted = st.form_submit_button("Add Challenge")
+            
+            if submitted:
+                existing_names = [c['name'] for c in WEEKLY_CHALLENGES + user_data.get('custom_challenges', [])]
+                if not challenge_name:
+                    st.error("Please enter a challenge name")
+                elif challenge_name in existing_names:
+                    st.error("A challenge with this name already exists")
+                else:
+                    user_data.setdefault('custom_challenges', []).append({
+                        'name': challenge_name,
+                        'description': challenge_description or f"{CHALLENGE_TYPES[challenge_type]}: {challenge_target} this week",
+                        'target': challenge_target,
+                        'type': challenge_type,
+                        'points': challenge_points,
+                        'created': datetime.now().strftime('%Y-%m-%d')
+                    })
+                    update_user_data(user_data)
+                    st.success(f"✅ Challenge '{challenge_name}' added for your class!")
+                    st.rerun()
+        
+        custom_challenges = user_data.get('custom_challenges', [])
+        if custom_challenges:
+            st.write("### Your Challenges")
+            
+            period = challenge_period_key()
+            for idx, challenge in enumerate(custom_challenges):
+                # Completions this week, read straight from each student's counters
+                completed_count = sum(1 for student in students_data.values()
+                                      if challenge['name'] in get_period_counters(student, period)['completed'])
+                
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.write(f"**{challenge['name']}** - {challenge['description']} "
+                             f"(target {challenge['target']}, +{challenge['points']} pts) | "
+                             f"{completed_count}/{len(students_data)} completed this week")
+                with col2:
+                    if st.button("🗑️ Delete", key=f"delete_challenge_{idx}"):
+                        custom_challenges.pop(idx)
+                        update_user_data(user_data)
+                        st.rerun()
+        else:
+            st.info("No class challenges yet. Create one above!")
+    
+    with tab6:
+        st.subheader("Bulk NAPFA Upload")
+        st.write("Upload a whole class's NAPFA results at once. Age and gender can be left blank to use each "
+                 "student's profile, the date defaults to today and the 2.4km run can be m:ss or minutes.")
+        
+        st.download_button(
+            label="📄 Download CSV Template",
+            data=napfa_upload_template(),
+            file_name="napfa_upload_template.csv",
+            mime="text/csv"
+        )
+        
+        if st.session_state.get('napfa_upload_saved'):
+            st.success(st.session_state.pop('napfa_upload_saved'))
+        
+        # A new key after each save clears the uploaded file
+        upload_round = st.session_state.get('napfa_upload_round', 0)
+        uploaded_file = st.file_uploader("Results file", type=['csv', 'xlsx'], key=f"napfa_upload_file_{upload_round}")
+        
+        if uploaded_file is not None:
+            try:
+                upload_df = read_napfa_upload(uploaded_file)
+            except ImportError as e:
+                st.error(f"Reading Excel files needs an extra package: {e.name} (pip install {e.name})")
+                upload_df = None
+            except Exception as e:
+                st.error(f"Could not read the file: {e}")
+                upload_df = None
+            
+            if upload_df is not None:
+                graded, upload_errors = grade_napfa_upload(upload_df, all_users, set(students_data.keys()))
+                
+                if graded is None:
+                    st.error(upload_errors[1][0])
+                else:
+                    valid_count = int(graded['valid'].sum())
+                    
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("Rows", len(graded))
+                    col2.metric("Ready to Save", valid_count)
+                    col3.metric("Errors", len(graded) - valid_count)
+                    
+                    # Dry run: nothing is written until the results are confirmed
+                    st.write("### Preview")
+                    preview_columns = ['Row', 'username', 'name', 'date'] + [f"{code} grade" for code in NAPFA_COMPONENTS] + ['total', 'medal']
+                    st.dataframe(graded.loc[graded['valid'], preview_columns], use_container_width=True, hide_index=True)
+                    
+                    if upload_errors:
+                        st.write("### Rows with Errors")
+                        st.dataframe(pd.DataFrame([{'Row': row, 'Errors': '; '.join(messages)}
+                                                   for row, messages in sorted(upload_errors.items())]),
+                                     use_container_width=True, hide_index=True)
+                        st.caption("Rows with errors are skipped. Fix them and upload the file again to add them.")
+                    
+                    if valid_count and st.button(f"✅ Save {valid_count} Results", key="save_napfa_upload"):
+                        saved = save_napfa_upload(graded, all_users)
+                        save_users(all_users)
+                        st.session_state.napfa_upload_saved = f"✅ Saved NAPFA results for {saved} students"
+                        st.session_state.napfa_upload_round = upload_round + 1
+                        st.rerun()
 
 # Schedule Manager
 def schedule_manager():